@@ -0,0 +1,30 @@
+"""
+Benchmark fixtures - synthetic corpus shared by the ingestion benchmarks
+Scale: BENCH_BOOKS=100000 pytest benchmarks/ --benchmark-only
+Compare: pytest benchmarks/ --benchmark-only --benchmark-autosave --benchmark-compare --benchmark-compare-fail=mean:20%
+"""
+
+import os
+import pytest
+
+from corpus import generate_corpus
+
+CORPUS_PARAMS = {
+    'n_books': int(os.getenv('BENCH_BOOKS', '100')),
+    'words_per_book': int(os.getenv('BENCH_WORDS_PER_BOOK', '2000')),
+    'vocab_size': int(os.getenv('BENCH_VOCAB_SIZE', '50000')),
+    'zipf_s': float(os.getenv('BENCH_ZIPF_S', '1.1')),
+}
+
+
+@pytest.fixture(scope="session")
+def zipf_corpus(tmp_path_factory):
+    """Directory and book ids of the synthetic corpus, generated once per session"""
+    corpus_dir = os.getenv('BENCH_CORPUS_DIR') or tmp_path_factory.mktemp('zipf_corpus')
+    book_ids = generate_corpus(corpus_dir, **CORPUS_PARAMS)
+    return corpus_dir, book_ids
+
+
+def pytest_benchmark_update_machine_info(config, machine_info):
+    """Record the corpus shape in the JSON output so runs are only compared like for like"""
+    machine_info['corpus'] = CORPUS_PARAMS
@@ -9,11 +9,24 @@ import sys
 import os
 import psutil
 import time
+import json
+from pathlib import Path
 sys.path.append('/app')
 sys.path.append('/app/application')
 
 from storage_backends import RedisBackend, PostgreSQLBackend
 from indexer import Indexer
+from analysis import ANALYZERS, get_analyzer
+from datalake import DATALAKE_FORMATS, LooseDatalake, open_datalake
+
+# minimum throughput per benchmark name, a run below the floor fails
+THRESHOLDS_PATH = Path(os.getenv('BENCH_THRESHOLDS', Path(__file__).with_name('thresholds.json')))
+THRESHOLDS = json.loads(THRESHOLDS_PATH.read_text()) if THRESHOLDS_PATH.exists() else {}
+
+STAGE_BACKENDS = [RedisBackend, PostgreSQLBackend]
+
+# books of the synthetic corpus used by the per-book stage benchmarks
+STAGE_SAMPLE_BOOKS = 20
 
 
 @pytest.fixture
@@ -117,6 +130,52 @@ def test_postgres_search_speed(benchmark):
     return result
 
 
+@pytest.fixture
+def ingest_words():
+    """Vocabulary of one large book for per-word vs bulk ingest comparison"""
+    return [f'ingestword_{i}' for i in range(5000)]
+
+
+def _record_throughput(benchmark, n_items, unit):
+    """Store items/sec in the JSON output and enforce the floor from thresholds.json"""
+    if not benchmark.stats:
+        return
+    per_sec = n_items / benchmark.stats.stats.mean
+    benchmark.extra_info[f'{unit}_per_sec'] = round(per_sec, 1)
+    print(f"\n  {benchmark.name}: {per_sec:,.0f} {unit}/sec")
+
+    floor = THRESHOLDS.get(benchmark.name, {}).get(f'{unit}_per_sec')
+    if floor:
+        assert per_sec >= floor, f"{benchmark.name}: {per_sec:,.0f} {unit}/sec is below the {floor:,} floor"
+
+
+@pytest.mark.benchmark(group="ingest")
+@pytest.mark.parametrize("backend_class", [RedisBackend, PostgreSQLBackend])
+def test_per_word_ingest_speed(benchmark, backend_class, ingest_words):
+    """Baseline: one add_word_to_index round-trip per word"""
+    backend = backend_class()
+
+    def ingest_operation():
+        for word in ingest_words:
+            backend.add_word_to_index(word, 'ingest_per_word_001')
+
+    benchmark.pedantic(ingest_operation, rounds=3, iterations=1)
+    _record_throughput(benchmark, len(ingest_words), 'words')
+
+
+@pytest.mark.benchmark(group="ingest")
+@pytest.mark.parametrize("backend_class", [RedisBackend, PostgreSQLBackend])
+def test_bulk_ingest_speed(benchmark, backend_class, ingest_words):
+    """Chunked add_book_postings: pipelines / multi-row INSERT in one transaction"""
+    backend = backend_class()
+
+    def ingest_operation():
+        backend.add_book_postings('ingest_bulk_001', ingest_words)
+
+    benchmark.pedantic(ingest_operation, rounds=3, iterations=1)
+    _record_throughput(benchmark, len(ingest_words), 'words')
+
+
 def test_multiple_books_indexing_redis(multiple_books_data):
     """Test Redis performance with multiple books"""
     backend = RedisBackend()
@@ -201,5 +260,112 @@ def test_memory_usage_monitoring():
     assert memory_increase < 50.0, "Memory leak detected"
 
 
-def test_your_performance_benchmark_template():
-    """Kacper, dodaj inne benchmarki jak chcesz a jak nie przygotuj tylko wykresy na podstawie tego co jest u gory"""
+@pytest.fixture(scope="module")
+def tokenized_sample(zipf_corpus):
+    """process_book output for the first books of the synthetic corpus"""
+    corpus_dir, book_ids = zipf_corpus
+    indexer = Indexer(None)
+    indexer.datalake_path = Path(corpus_dir)
+    return [indexer.process_book(book_id) for book_id in book_ids[:STAGE_SAMPLE_BOOKS]]
+
+
+@pytest.mark.benchmark(group="stage-process_book")
+def test_process_book_throughput(benchmark, zipf_corpus, tokenized_sample):
+    """Stage 1: read and tokenize a book, the same for every backend"""
+    corpus_dir, book_ids = zipf_corpus
+    indexer = Indexer(None)
+    indexer.datalake_path = Path(corpus_dir)
+    sample = book_ids[:STAGE_SAMPLE_BOOKS]
+
+    def process_operation():
+        return [indexer.process_book(book_id) for book_id in sample]
+
+    benchmark.pedantic(process_operation, rounds=3, iterations=1)
+    _record_throughput(benchmark, sum(book['word_count'] for book in tokenized_sample), 'words')
+
+
+@pytest.mark.benchmark(group="stage-analyzer")
+@pytest.mark.parametrize("analyzer", sorted(ANALYZERS))
+def test_analyzer_throughput(benchmark, analyzer, zipf_corpus, tokenized_sample):
+    """Stage 1 per analyzer, with the vocabulary and postings it leaves for the backend"""
+    corpus_dir, book_ids = zipf_corpus
+    indexer = Indexer(None, analyzer=get_analyzer(analyzer))
+    indexer.datalake_path = Path(corpus_dir)
+    sample = book_ids[:STAGE_SAMPLE_BOOKS]
+
+    def process_operation():
+        return [indexer.process_book(book_id) for book_id in sample]
+
+    processed = benchmark.pedantic(process_operation, rounds=3, iterations=1)
+    benchmark.extra_info['vocabulary'] = len(set().union(*(book['all_words'] for book in processed)))
+    benchmark.extra_info['postings'] = sum(len(book['all_words']) for book in processed)
+    _record_throughput(benchmark, sum(book['word_count'] for book in tokenized_sample), 'words')
+
+
+@pytest.mark.benchmark(group="stage-datalake")
+@pytest.mark.parametrize("datalake_format", DATALAKE_FORMATS)
+def test_datalake_read_throughput(benchmark, datalake_format, zipf_corpus, tokenized_sample, tmp_path):
+    """Stage 1 reading from loose files or packed segments, with the bytes each keeps on disk"""
+    import shutil
+    corpus_dir, book_ids = zipf_corpus
+    sample = book_ids[:STAGE_SAMPLE_BOOKS]
+    loose = LooseDatalake(corpus_dir)
+    datalake = open_datalake(tmp_path, datalake_format)
+    for book_id in sample:
+        staged = datalake.staging_paths(book_id)
+        for source, target in zip(loose._paths(book_id), staged):
+            shutil.copy(source, target)
+        datalake.commit_book(book_id, *staged)
+    indexer = Indexer(None, datalake=datalake)
+
+    def process_operation():
+        return [indexer.process_book(book_id) for book_id in sample]
+
+    benchmark.pedantic(process_operation, rounds=3, iterations=1)
+    benchmark.extra_info['disk_bytes'] = sum(p.stat().st_size for p in tmp_path.rglob('*') if p.is_file())
+    benchmark.extra_info['raw_bytes'] = sum(datalake.fingerprint(book_id)['size'] for book_id in sample)
+    _record_throughput(benchmark, sum(book['word_count'] for book in tokenized_sample), 'words')
+
+
+@pytest.mark.benchmark(group="stage-index_book")
+@pytest.mark.parametrize("backend_class", STAGE_BACKENDS)
+def test_index_book_throughput(benchmark, backend_class, tokenized_sample):
+    """Stage 2: write metadata and postings of already tokenized books"""
+    indexer = Indexer(backend_class())
+
+    def delete_books():
+        # index_book only writes the diff against a book's forward index, every round starts from nothing
+        for book_data in tokenized_sample:
+            indexer.backend.delete_book(book_data['book_id'])
+        indexer.backend.flush()
+
+    def index_operation():
+        for book_data in tokenized_sample:
+            indexer.index_book(book_data)
+
+    benchmark.pedantic(index_operation, setup=delete_books, rounds=3, iterations=1)
+    _record_throughput(benchmark, len(tokenized_sample), 'books')
+
+
+@pytest.mark.benchmark(group="stage-index_all_books")
+@pytest.mark.parametrize("backend_class", STAGE_BACKENDS)
+def test_index_all_books_throughput(benchmark, backend_class, zipf_corpus, tmp_path):
+    """End to end: scan, tokenize and write the whole synthetic corpus"""
+    corpus_dir, book_ids = zipf_corpus
+    indexer = Indexer(backend_class(), manifest_path=tmp_path / 'manifest.json')
+    indexer.datalake_path = Path(corpus_dir)
+    workers = int(os.getenv('BENCH_WORKERS', '1'))
+
+    benchmark.pedantic(indexer.index_all_books, kwargs={'force_reindex': True, 'workers': workers},
+                       rounds=1, iterations=1)
+    _record_throughput(benchmark, len(book_ids), 'books')
+
+
+@pytest.mark.benchmark(group="stage-get_stats")
+@pytest.mark.parametrize("backend_class", STAGE_BACKENDS)
+def test_get_stats_speed(benchmark, backend_class, zipf_corpus):
+    """get_stats after the corpus is indexed, independent of corpus size"""
+    backend = backend_class()
+
+    benchmark(backend.get_stats)
+    _record_throughput(benchmark, 1, 'calls')
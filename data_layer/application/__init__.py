@@ -2,8 +2,10 @@
 Data Layer Application Package
 """
 
-from .storage_backends import RedisBackend, PostgreSQLBackend
+from .storage_backends import RedisBackend, BitmapRedisBackend, PostgreSQLBackend, CompactPostgreSQLBackend, EmbeddedBackend, ShardedBackend
 from .indexer import Indexer
 from .downloader import download_books
+from .snapshot import export_snapshot, import_snapshot
 
-__all__ = ['RedisBackend', 'PostgreSQLBackend', 'Indexer', 'download_books']
\ No newline at end of file
+__all__ = ['RedisBackend', 'BitmapRedisBackend', 'PostgreSQLBackend', 'CompactPostgreSQLBackend', 'EmbeddedBackend', 'ShardedBackend', 'Indexer', 'download_books',
+           'export_snapshot', 'import_snapshot']
\ No newline at end of file
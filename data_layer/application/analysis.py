@@ -0,0 +1,212 @@
+import functools
+import re
+from typing import Callable, Iterable, List, Optional
+
+# legacy tokens: ASCII letters only, what every index before analyzers was built with
+ASCII_TOKEN_PATTERN = r'\b[a-zA-Z]+\b'
+
+# runs of Unicode letters, so café, naïve and Brontë stay one token
+UNICODE_TOKEN_PATTERN = r'[^\W\d_]+'
+
+# distinct tokens whose analyzed term is remembered per analyzer
+TERM_MEMO_SIZE = 1 << 16
+
+ENGLISH_STOPWORDS = frozenset('''
+a about above after again against all am an and any are as at be because been before being below between
+both but by can could did do does doing down during each few for from further had has have having he her
+here hers herself him himself his how i if in into is it its itself just me more most my myself no nor not
+now of off on once only or other our ours ourselves out over own same she should so some such than that
+the their theirs them themselves then there these they this those through to too under until up upon very
+was we were what when where which while who whom why will with would you your yours yourself yourselves
+'''.split())
+
+
+class PorterStemmer:
+    '''M. F. Porter's 1980 suffix stripping algorithm for English
+
+    walk, walks, walked and walking all become walk; input is expected
+    lowercase, words of two letters or less are returned as they are
+    '''
+
+    VOWELS = frozenset('aeiou')
+
+    def _is_consonant(self, word: str, i: int) -> bool:
+        if word[i] in self.VOWELS:
+            return False
+        if word[i] == 'y':
+            return i == 0 or not self._is_consonant(word, i - 1)
+        return True
+
+    def _measure(self, stem: str) -> int:
+        '''number of vowel-consonant sequences, the m of [C](VC){m}[V]'''
+        m = 0
+        previous_vowel = False
+        for i in range(len(stem)):
+            vowel = not self._is_consonant(stem, i)
+            if previous_vowel and not vowel:
+                m += 1
+            previous_vowel = vowel
+        return m
+
+    def _has_vowel(self, stem: str) -> bool:
+        return any(not self._is_consonant(stem, i) for i in range(len(stem)))
+
+    def _double_consonant(self, word: str) -> bool:
+        return len(word) > 1 and word[-1] == word[-2] and self._is_consonant(word, len(word) - 1)
+
+    def _cvc(self, word: str) -> bool:
+        '''ends consonant-vowel-consonant with the last one not w, x or y (hop, not hoop)'''
+        return (len(word) > 2 and self._is_consonant(word, len(word) - 1)
+                and not self._is_consonant(word, len(word) - 2) and self._is_consonant(word, len(word) - 3)
+                and word[-1] not in 'wxy')
+
+    def _replace(self, word: str, rules, min_measure: int) -> str:
+        '''first matching suffix is replaced when the stem before it has measure > min_measure'''
+        for suffix, replacement in rules:
+            if word.endswith(suffix):
+                stem = word[:len(word) - len(suffix)]
+                return stem + replacement if self._measure(stem) > min_measure else word
+        return word
+
+    STEP2 = (('ational', 'ate'), ('tional', 'tion'), ('enci', 'ence'), ('anci', 'ance'), ('izer', 'ize'),
+             ('abli', 'able'), ('alli', 'al'), ('entli', 'ent'), ('eli', 'e'), ('ousli', 'ous'),
+             ('ization', 'ize'), ('ation', 'ate'), ('ator', 'ate'), ('alism', 'al'), ('iveness', 'ive'),
+             ('fulness', 'ful'), ('ousness', 'ous'), ('aliti', 'al'), ('iviti', 'ive'), ('biliti', 'ble'))
+    STEP3 = (('icate', 'ic'), ('ative', ''), ('alize', 'al'), ('iciti', 'ic'), ('ical', 'ic'), ('ful', ''),
+             ('ness', ''))
+    # longest first, so ement is tried before ment and ent
+    STEP4 = ('ement', 'ance', 'ence', 'able', 'ible', 'ment', 'ant', 'ent', 'ion', 'ism', 'ate', 'iti', 'ous',
+             'ive', 'ize', 'al', 'er', 'ic', 'ou')
+
+    def _step1(self, word: str) -> str:
+        if word.endswith('sses') or word.endswith('ies'):
+            word = word[:-2]
+        elif word.endswith('s') and not word.endswith('ss'):
+            word = word[:-1]
+
+        if word.endswith('eed'):
+            return word[:-1] if self._measure(word[:-3]) > 0 else word
+        for suffix in ('ed', 'ing'):
+            if word.endswith(suffix) and self._has_vowel(word[:-len(suffix)]):
+                word = word[:-len(suffix)]
+                if word.endswith(('at', 'bl', 'iz')):
+                    return word + 'e'
+                if self._double_consonant(word) and word[-1] not in 'lsz':
+                    return word[:-1]
+                if self._measure(word) == 1 and self._cvc(word):
+                    return word + 'e'
+                return word
+        return word
+
+    def _step4(self, word: str) -> str:
+        for suffix in self.STEP4:
+            if word.endswith(suffix):
+                stem = word[:-len(suffix)]
+                if suffix == 'ion' and not stem.endswith(('s', 't')):
+                    return word
+                return stem if self._measure(stem) > 1 else word
+        return word
+
+    def _step5(self, word: str) -> str:
+        if word.endswith('e'):
+            stem = word[:-1]
+            m = self._measure(stem)
+            if m > 1 or (m == 1 and not self._cvc(stem)):
+                word = stem
+        if word.endswith('ll') and self._measure(word) > 1:
+            word = word[:-1]
+        return word
+
+    def stem(self, word: str) -> str:
+        if len(word) <= 2:
+            return word
+        word = self._step1(word)
+        if word.endswith('y') and self._has_vowel(word[:-1]):
+            word = word[:-1] + 'i'
+        word = self._replace(word, self.STEP2, 0)
+        word = self._replace(word, self.STEP3, 0)
+        word = self._step4(word)
+        return self._step5(word)
+
+    def __call__(self, word: str) -> str:
+        return self.stem(word)
+
+
+class Analyzer:
+    '''tokenizer -> lowercase -> length / stopword filter -> stemmer, shared by indexing and querying
+
+    tokens() splits text the way positions are counted, term() maps one
+    token to its indexed term or None when it is dropped; term() is
+    memoized in an LRU of memo_size entries, Zipfian text repeats the same
+    few tokens all the time; an index has to be queried with the analyzer
+    it was built with
+    '''
+
+    def __init__(self, name: str = 'custom', pattern: str = ASCII_TOKEN_PATTERN, min_length: int = 3,
+                 stopwords: Iterable[str] = (), stemmer: Optional[Callable[[str], str]] = None,
+                 memo_size: int = TERM_MEMO_SIZE):
+        self.name = name
+        self.pattern = re.compile(pattern)
+        self.min_length = min_length
+        self.stopwords = frozenset(stopwords)
+        self.stemmer = stemmer
+        self.memo_size = memo_size
+        self.term = functools.lru_cache(maxsize=memo_size)(self._term)
+
+    def __getstate__(self):
+        '''the memo is process local, pool workers build their own'''
+        state = self.__dict__.copy()
+        del state['term']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.term = functools.lru_cache(maxsize=self.memo_size)(self._term)
+
+    def __repr__(self) -> str:
+        return f'Analyzer({self.name!r})'
+
+    def _term(self, token: str) -> Optional[str]:
+        if len(token) < self.min_length or token in self.stopwords:
+            return None
+        return self.stemmer(token) if self.stemmer else token
+
+    def tokens(self, text: str) -> List[str]:
+        return self.pattern.findall(text.lower())
+
+    def analyze(self, text: str) -> List[str]:
+        '''indexed terms of text in order, dropped tokens left out'''
+        return [term for term in map(self.term, self.tokens(text)) if term]
+
+    def memo_info(self):
+        return self.term.cache_info()
+
+
+def legacy_analyzer() -> Analyzer:
+    '''ASCII words of 3+ letters as they are, the default'''
+    return Analyzer('legacy')
+
+
+def unicode_analyzer() -> Analyzer:
+    '''words of 3+ Unicode letters as they are'''
+    return Analyzer('unicode', pattern=UNICODE_TOKEN_PATTERN)
+
+
+def english_analyzer() -> Analyzer:
+    '''Unicode words of 3+ letters without English stopwords, Porter stemmed'''
+    return Analyzer('english', pattern=UNICODE_TOKEN_PATTERN, stopwords=ENGLISH_STOPWORDS, stemmer=PorterStemmer())
+
+
+ANALYZERS = {
+    'legacy': legacy_analyzer,
+    'unicode': unicode_analyzer,
+    'english': english_analyzer,
+}
+
+
+def get_analyzer(name: str) -> Analyzer:
+    '''analyzer for an ANALYZER name'''
+    try:
+        return ANALYZERS[name.lower()]()
+    except KeyError:
+        raise ValueError(f'Unknown analyzer: {name}, expected one of {", ".join(ANALYZERS)}') from None
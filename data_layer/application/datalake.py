@@ -0,0 +1,416 @@
+import hashlib
+import io
+import json
+import os
+import sys
+import threading
+import zlib
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Dict, Optional, TextIO, Tuple
+
+from application.consts import DATALAKE_PATH
+
+HASH_BLOCK_SIZE = 1 << 20
+
+# a packed segment takes new books until it passes this many compressed bytes
+PACK_SEGMENT_SIZE = 256 << 20
+
+# compressed bytes read from a segment per step of a lazy read
+PACK_READ_SIZE = 64 << 10
+
+PACK_COMPRESSION_LEVEL = 6
+
+# share of a segment's bytes held by replaced books past which it is rewritten
+PACK_DEAD_RATIO = 0.5
+
+# the offset index of a packed datalake, its presence marks the format
+PACK_INDEX = Path('packs') / 'index.jsonl'
+
+DATALAKE_FORMATS = ('loose', 'packed')
+
+
+def file_digest(*paths: Path) -> str:
+    '''sha256 over the concatenated contents of the given files'''
+    digest = hashlib.sha256()
+    for path in paths:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+class Datalake(ABC):
+    '''downloaded books as a header and a body text per book_id
+
+    the downloader writes a book to staging_paths() and hands it over with
+    commit_book(); process_book reads it back with read_header() and
+    open_body(); scan() / fingerprint() / digest() feed the manifest
+    '''
+
+    def __init__(self, path):
+        self.path = Path(path)
+
+    def staging_paths(self, book_id: str) -> Tuple[Path, Path]:
+        '''header and body files a download is written to before commit_book'''
+        return self.path / f'header_{book_id}.txt.part', self.path / f'body_{book_id}.txt.part'
+
+    @abstractmethod
+    def commit_book(self, book_id: str, header_path: Path, body_path: Path) -> None:
+        '''take over a book from its staged files, replacing any previous copy'''
+        pass
+
+    @abstractmethod
+    def has_book(self, book_id: str) -> bool:
+        pass
+
+    @abstractmethod
+    def scan(self) -> Dict[str, Optional[Dict]]:
+        '''every book_id with a header, mapped to its size / mtime_ns fingerprint, None while the body is missing'''
+        pass
+
+    @abstractmethod
+    def fingerprint(self, book_id: str) -> Dict:
+        pass
+
+    @abstractmethod
+    def digest(self, book_id: str) -> str:
+        '''sha256 over the header then the body bytes'''
+        pass
+
+    @abstractmethod
+    def open_header(self, book_id: str) -> TextIO:
+        pass
+
+    @abstractmethod
+    def open_body(self, book_id: str) -> TextIO:
+        '''text stream over the body, read as it is consumed'''
+        pass
+
+    def read_header(self, book_id: str) -> str:
+        with self.open_header(book_id) as f:
+            return f.read()
+
+
+class LooseDatalake(Datalake):
+    '''header_{book_id}.txt and body_{book_id}.txt side by side, the original layout'''
+
+    def _paths(self, book_id: str) -> Tuple[Path, Path]:
+        return self.path / f'header_{book_id}.txt', self.path / f'body_{book_id}.txt'
+
+    def commit_book(self, book_id: str, header_path: Path, body_path: Path) -> None:
+        header, body = self._paths(book_id)
+        os.replace(header_path, header)
+        os.replace(body_path, body)
+
+    def has_book(self, book_id: str) -> bool:
+        return all(path.exists() for path in self._paths(book_id))
+
+    @staticmethod
+    def _fingerprint(header_stat: os.stat_result, body_stat: os.stat_result) -> Dict:
+        return {
+            'size': header_stat.st_size + body_stat.st_size,
+            'mtime_ns': max(header_stat.st_mtime_ns, body_stat.st_mtime_ns)
+        }
+
+    def scan(self) -> Dict[str, Optional[Dict]]:
+        stats = {}
+        if self.path.is_dir():
+            with os.scandir(self.path) as it:
+                for entry in it:
+                    if entry.name.endswith('.txt') and entry.name.startswith(('header_', 'body_')):
+                        stats[entry.name] = entry.stat()
+
+        books = {}
+        for name, header_stat in stats.items():
+            if name.startswith('header_'):
+                book_id = name[len('header_'):-len('.txt')]
+                body_stat = stats.get(f'body_{book_id}.txt')
+                books[book_id] = self._fingerprint(header_stat, body_stat) if body_stat else None
+        return books
+
+    def fingerprint(self, book_id: str) -> Dict:
+        return self._fingerprint(*(os.stat(path) for path in self._paths(book_id)))
+
+    def digest(self, book_id: str) -> str:
+        return file_digest(*self._paths(book_id))
+
+    def open_header(self, book_id: str) -> TextIO:
+        return open(self._paths(book_id)[0], 'r', encoding='utf-8')
+
+    def open_body(self, book_id: str) -> TextIO:
+        return open(self._paths(book_id)[1], 'r', encoding='utf-8')
+
+
+class _InflatingReader(io.RawIOBase):
+    '''raw stream over one zlib member of a segment, read with pread so readers share the fd'''
+
+    def __init__(self, fd: int, offset: int, length: int):
+        self._fd = fd
+        self._position = offset
+        self._end = offset + length
+        self._inflater = zlib.decompressobj()
+        self._pending = b''
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self._pending and not self._inflater.eof:
+            if self._position >= self._end:
+                raise EOFError('packed datalake segment is truncated')
+            compressed = os.pread(self._fd, min(PACK_READ_SIZE, self._end - self._position), self._position)
+            if not compressed:
+                raise EOFError('packed datalake segment is truncated')
+            self._position += len(compressed)
+            self._pending = self._inflater.decompress(compressed)
+        n = min(len(buffer), len(self._pending))
+        buffer[:n] = self._pending[:n]
+        self._pending = self._pending[n:]
+        return n
+
+
+class PackedDatalake(Datalake):
+    '''books appended to compressed segment files, found through an offset index
+
+    each book is a zlib member for its header and one for its body in
+    packs/seg_{n}.pack; packs/index.jsonl is an append-only log of where
+    they are, the last entry of a book wins; one open fd per segment
+    serves every read, bodies are inflated as they are consumed
+
+    a single process commits books; readers in other processes pick up
+    new index entries on their first miss, and instances are shared per
+    process so pool workers do not reload the index for every book
+
+    a re-committed book leaves its old members behind as dead bytes of
+    their segment; once those pass PACK_DEAD_RATIO of it, the live books
+    are copied to the writable segment and the old one is removed
+    '''
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.pack_path = self.path / PACK_INDEX.parent
+        self._entries = {}
+        self._index_offset = 0
+        self._fds = {}
+        self._segment = None
+        self._dead = {}
+        self._lock = threading.Lock()
+        self._refresh()
+
+    def __reduce__(self):
+        return open_packed, (str(self.path),)
+
+    def _refresh(self) -> None:
+        '''read index entries appended since the last refresh'''
+        index_path = self.path / PACK_INDEX
+        if not index_path.exists():
+            return
+        with open(index_path, 'rb') as f:
+            f.seek(self._index_offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # the writer is halfway through this entry
+                    break
+                entry = json.loads(line)
+                self._set_entry(entry.pop('book_id'), entry)
+                self._index_offset += len(line)
+
+    def _set_entry(self, book_id: str, entry: Dict) -> None:
+        '''point book_id at entry, the members it pointed at before become dead bytes'''
+        previous = self._entries.get(book_id)
+        if previous is not None and previous != entry:
+            self._dead[previous['segment']] = self._dead.get(previous['segment'], 0) + \
+                previous['header'][1] + previous['body'][1]
+        self._entries[book_id] = entry
+
+    def _append_index(self, entries: Dict[str, Dict]) -> None:
+        '''log entries after the data they point at, the writer's own lines count as read'''
+        lines = ''.join(json.dumps({'book_id': book_id, **entry}) + '\n' for book_id, entry in entries.items())
+        with open(self.path / PACK_INDEX, 'a', encoding='utf-8') as f:
+            f.write(lines)
+        self._index_offset += len(lines.encode('utf-8'))
+        for book_id, entry in entries.items():
+            self._set_entry(book_id, entry)
+
+    def _entry(self, book_id: str) -> Dict:
+        entry = self._entries.get(book_id)
+        if entry is None:
+            self._refresh()
+            entry = self._entries.get(book_id)
+            if entry is None:
+                raise FileNotFoundError(f'Book {book_id} is not in the packed datalake {self.path}')
+        return entry
+
+    def _segment_path(self, segment: int) -> Path:
+        return self.pack_path / f'seg_{segment:06d}.pack'
+
+    def _fd(self, segment: int) -> int:
+        fd = self._fds.get(segment)
+        if fd is None:
+            fd = self._fds[segment] = os.open(self._segment_path(segment), os.O_RDONLY)
+        return fd
+
+    def _writable_segment(self) -> int:
+        if self._segment is None:
+            segments = sorted(self.pack_path.glob('seg_*.pack'))
+            self._segment = int(segments[-1].stem.split('_')[1]) if segments else 0
+        if self._segment_path(self._segment).exists() and \
+                self._segment_path(self._segment).stat().st_size >= PACK_SEGMENT_SIZE:
+            self._segment += 1
+        return self._segment
+
+    @staticmethod
+    def _deflate(source: Path, out, digest) -> Tuple[int, int, int]:
+        '''append source to out as one zlib member, returns (offset, compressed, raw) sizes'''
+        offset = out.tell()
+        deflater = zlib.compressobj(PACK_COMPRESSION_LEVEL)
+        raw = 0
+        with open(source, 'rb') as f:
+            for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+                digest.update(block)
+                raw += len(block)
+                out.write(deflater.compress(block))
+        out.write(deflater.flush())
+        return offset, out.tell() - offset, raw
+
+    def commit_book(self, book_id: str, header_path: Path, body_path: Path) -> None:
+        # keep the staged files' mtime, so a loose book packed as is keeps its manifest fingerprint
+        mtime_ns = max(os.stat(header_path).st_mtime_ns, os.stat(body_path).st_mtime_ns)
+        with self._lock:
+            self.pack_path.mkdir(parents=True, exist_ok=True)
+            self._refresh()
+            previous = self._entries.get(book_id)
+            segment = self._writable_segment()
+            digest = hashlib.sha256()
+            with open(self._segment_path(segment), 'ab') as out:
+                header = self._deflate(header_path, out, digest)
+                body = self._deflate(body_path, out, digest)
+            entry = {
+                'segment': segment,
+                'header': list(header[:2]),
+                'body': list(body[:2]),
+                'size': header[2] + body[2],
+                'mtime_ns': mtime_ns,
+                'sha256': digest.hexdigest()
+            }
+            self._append_index({book_id: entry})
+            if previous is not None:
+                replaced = previous['segment']
+                if self._dead.get(replaced, 0) >= PACK_DEAD_RATIO * self._segment_path(replaced).stat().st_size:
+                    self._compact(replaced)
+        os.remove(header_path)
+        os.remove(body_path)
+
+    def _compact(self, segment: int) -> None:
+        '''copy the live books of segment to the writable segment, then remove it'''
+        if segment == self._writable_segment():
+            self._segment += 1
+        target = self._writable_segment()
+        source = self._fd(segment)
+        moved = {}
+        with open(self._segment_path(target), 'ab') as out:
+            for book_id, entry in self._entries.items():
+                if entry['segment'] != segment:
+                    continue
+                parts = {}
+                # zlib members are copied as they are, nothing is inflated again
+                for part in ('header', 'body'):
+                    offset, length = entry[part]
+                    parts[part] = [out.tell(), length]
+                    for start in range(offset, offset + length, PACK_READ_SIZE):
+                        out.write(os.pread(source, min(PACK_READ_SIZE, offset + length - start), start))
+                moved[book_id] = {**entry, 'segment': target, **parts}
+        self._append_index(moved)
+        os.close(self._fds.pop(segment))
+        os.remove(self._segment_path(segment))
+        self._dead.pop(segment, None)
+
+    def dead_bytes(self) -> Dict[int, int]:
+        '''compressed bytes per segment no index entry points at any more'''
+        self._refresh()
+        return {segment: dead for segment, dead in self._dead.items() if self._segment_path(segment).exists()}
+
+    def has_book(self, book_id: str) -> bool:
+        try:
+            self._entry(book_id)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def scan(self) -> Dict[str, Optional[Dict]]:
+        self._refresh()
+        return {book_id: {'size': entry['size'], 'mtime_ns': entry['mtime_ns']}
+                for book_id, entry in self._entries.items()}
+
+    def fingerprint(self, book_id: str) -> Dict:
+        entry = self._entry(book_id)
+        return {'size': entry['size'], 'mtime_ns': entry['mtime_ns']}
+
+    def digest(self, book_id: str) -> str:
+        return self._entry(book_id)['sha256']
+
+    def _open(self, book_id: str, part: str) -> TextIO:
+        entry = self._entry(book_id)
+        try:
+            fd = self._fd(entry['segment'])
+        except FileNotFoundError:
+            # the writer compacted the segment away, the book's new entry is further down the index
+            self._refresh()
+            entry = self._entry(book_id)
+            fd = self._fd(entry['segment'])
+        reader = _InflatingReader(fd, *entry[part])
+        return io.TextIOWrapper(io.BufferedReader(reader, PACK_READ_SIZE), encoding='utf-8')
+
+    def open_header(self, book_id: str) -> TextIO:
+        return self._open(book_id, 'header')
+
+    def open_body(self, book_id: str) -> TextIO:
+        return self._open(book_id, 'body')
+
+    def pack_loose(self, loose: LooseDatalake) -> int:
+        '''move every complete book of a loose datalake into this one, returns the number moved'''
+        moved = 0
+        for book_id, fingerprint in sorted(loose.scan().items()):
+            if fingerprint is not None:
+                self.commit_book(book_id, *loose._paths(book_id))
+                moved += 1
+        return moved
+
+
+_PACKED = {}
+_PACKED_LOCK = threading.Lock()
+
+
+def open_packed(path) -> PackedDatalake:
+    '''the process wide PackedDatalake of path'''
+    key = os.path.abspath(path)
+    with _PACKED_LOCK:
+        datalake = _PACKED.get(key)
+        if datalake is None:
+            datalake = _PACKED[key] = PackedDatalake(key)
+        return datalake
+
+
+def open_datalake(path=DATALAKE_PATH, format: Optional[str] = None) -> Datalake:
+    '''datalake at path in the given format
+
+    without one, a directory holding a pack index is packed and anything
+    else follows DATALAKE_FORMAT, loose by default
+    '''
+    if format is None:
+        format = 'packed' if (Path(path) / PACK_INDEX).exists() else os.getenv('DATALAKE_FORMAT', 'loose')
+    if format == 'packed':
+        return open_packed(path)
+    if format == 'loose':
+        return LooseDatalake(path)
+    raise ValueError(f'Unknown datalake format: {format}, expected one of {", ".join(DATALAKE_FORMATS)}')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3 or sys.argv[1] != 'pack':
+        print('usage: python -m application.datalake pack PATH')
+        sys.exit(2)
+
+    moved = open_packed(sys.argv[2]).pack_loose(LooseDatalake(sys.argv[2]))
+    print(f'packed {moved} books into {Path(sys.argv[2]) / PACK_INDEX.parent}')
@@ -1,53 +1,223 @@
 import os
-from datetime import datetime
+import json
+import inspect
+from email.utils import formatdate
+from typing import Callable, List, Optional
 
 import asyncio
 import aiohttp
 import aiofile
 
 from .consts import DATALAKE_PATH
+from .datalake import Datalake, open_datalake
+
+START_MARKER = b"*** START OF THE PROJECT GUTENBERG EBOOK"
+END_MARKER = b"*** END OF THE PROJECT GUTENBERG EBOOK"
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class DownloadError(Exception):
+    pass
+
 
 def header_body_split(text):
-    START_MARKER = "*** START OF THE PROJECT GUTENBERG EBOOK"
-    END_MARKER = "*** END OF THE PROJECT GUTENBERG EBOOK"
-    
-    header, _ = text.split(START_MARKER, 1)
-    body, _ = text.split(END_MARKER, 1)
+    '''split a whole book the same way HeaderBodySplitter does while streaming'''
+    header, rest = text.split(START_MARKER.decode(), 1)
+    _, _, rest = rest.partition('\n')
+    body, _ = rest.split(END_MARKER.decode(), 1)
 
     return header, body
 
-def download_books(urls, out_dir=DATALAKE_PATH):
-    sema = asyncio.BoundedSemaphore(5)
+
+class HeaderBodySplitter:
+    '''route a byte stream to header and body files at the Gutenberg markers as it arrives
+
+    bytes that could be the beginning of a marker are held back until the
+    next chunk decides; consumed counts source bytes already written or
+    dropped, which is where a resumed download continues
+    '''
+    HEADER, START_LINE, BODY, TRAILER = 'header', 'start_line', 'body', 'trailer'
+
+    def __init__(self, header_file, body_file, state=HEADER, consumed=0):
+        self.header_file = header_file
+        self.body_file = body_file
+        self.state = state
+        self.consumed = consumed
+        self._pending = b''
+
+    async def _emit(self, sink, data: bytes):
+        if data:
+            await sink.write(data)
+        self.consumed += len(data)
+
+    async def _hold_back(self, sink, buf: bytes, marker: bytes):
+        keep = min(len(buf), len(marker) - 1)
+        await self._emit(sink, buf[:len(buf) - keep])
+        self._pending = buf[len(buf) - keep:]
+
+    async def feed(self, data: bytes):
+        buf = self._pending + data
+        self._pending = b''
+        while buf:
+            if self.state == self.HEADER:
+                idx = buf.find(START_MARKER)
+                if idx < 0:
+                    await self._hold_back(self.header_file, buf, START_MARKER)
+                    return
+                await self._emit(self.header_file, buf[:idx])
+                self.consumed += len(START_MARKER)
+                buf = buf[idx + len(START_MARKER):]
+                self.state = self.START_LINE
+            elif self.state == self.START_LINE:
+                idx = buf.find(b'\n')
+                dropped = buf if idx < 0 else buf[:idx + 1]
+                self.consumed += len(dropped)
+                buf = buf[len(dropped):]
+                if idx >= 0:
+                    self.state = self.BODY
+            elif self.state == self.BODY:
+                idx = buf.find(END_MARKER)
+                if idx < 0:
+                    await self._hold_back(self.body_file, buf, END_MARKER)
+                    return
+                await self._emit(self.body_file, buf[:idx])
+                buf = buf[idx:]
+                self.state = self.TRAILER
+            else:
+                self.consumed += len(buf)
+                return
+
+    async def finish(self):
+        if self.state == self.HEADER:
+            raise DownloadError('START marker not found')
+        if self.state == self.BODY:
+            await self._emit(self.body_file, self._pending)
+        self._pending = b''
+
+
+async def download_books_async(urls: List[str], out_dir=DATALAKE_PATH, concurrency: int = 5,
+                               retries: int = 3, backoff: float = 0.5, revalidate: bool = True,
+                               on_downloaded: Optional[Callable[[str], None]] = None,
+                               datalake: Optional[Datalake] = None) -> List[str]:
+    '''stream books into header/body files, returns the ids of books written
+
+    existing books are revalidated with If-None-Match / If-Modified-Since
+    and skipped on 304; interrupted downloads resume with a Range request
+    guarded by If-Range; connection errors and 429/5xx are retried with
+    exponential backoff; on_downloaded(book_id) fires as each book lands
+    and may be a coroutine function
+
+    books are staged as .part files next to the datalake and committed to
+    it once complete; datalake defaults to the one at out_dir in whatever
+    format it is
+    '''
+    sema = asyncio.BoundedSemaphore(concurrency)
+    os.makedirs(out_dir, exist_ok=True)
+    if datalake is None:
+        datalake = open_datalake(out_dir)
+
+    def load_state(path):
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        return {}
+
+    def save_state(path, state):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+
+    async def fetch_once(session, url, book_id, state_path, state):
+        h_part, b_part = map(str, datalake.staging_paths(book_id))
+        headers = {}
+
+        resuming = state.get('offset', 0) > 0 and os.path.exists(h_part) and os.path.exists(b_part)
+        if resuming:
+            headers['Range'] = f"bytes={state['offset']}-"
+            if state.get('etag') or state.get('last_modified'):
+                headers['If-Range'] = state.get('etag') or state['last_modified']
+        elif revalidate and datalake.has_book(book_id):
+            if state.get('etag'):
+                headers['If-None-Match'] = state['etag']
+            headers['If-Modified-Since'] = state.get('last_modified') or formatdate(
+                datalake.fingerprint(book_id)['mtime_ns'] / 1e9, usegmt=True)
+
+        async with session.get(url, headers=headers) as resp:
+            if resp.status == 304:
+                print(f'Book {book_id} not modified, skipping')
+                return False
+            if resp.status in RETRY_STATUSES:
+                raise aiohttp.ClientResponseError(resp.request_info, resp.history, status=resp.status)
+            if resp.status not in (200, 206):
+                raise DownloadError(f'HTTP {resp.status} for {url}')
+
+            if resp.status == 206 and resuming:
+                mode = 'ab'
+                splitter_state = dict(state=state['split_state'], consumed=state['offset'])
+            else:
+                mode = 'wb'
+                splitter_state = {}
+                state = {'etag': resp.headers.get('ETag'), 'last_modified': resp.headers.get('Last-Modified')}
+
+            async with aiofile.async_open(h_part, mode) as h_file, aiofile.async_open(b_part, mode) as b_file:
+                splitter = HeaderBodySplitter(h_file, b_file, **splitter_state)
+                try:
+                    async for chunk in resp.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                        await splitter.feed(chunk)
+                    await splitter.finish()
+                except (aiohttp.ClientError, asyncio.TimeoutError, asyncio.CancelledError):
+                    # everything up to consumed is on disk, the next attempt resumes there
+                    save_state(state_path, dict(state, offset=splitter.consumed, split_state=splitter.state))
+                    raise
+
+        # packing compresses the whole book, keep it off the event loop
+        await asyncio.get_running_loop().run_in_executor(None, datalake.commit_book, book_id, h_part, b_part)
+        save_state(state_path, state)
+        return True
 
     async def fetch_file(session, url):
         fname = url.split("/")[-1]
         book_id = fname.split('.')[0]
 
-        # Check if book already exists
-        h_path = os.path.join(out_dir, f'header_{book_id}.txt')
-        b_path = os.path.join(out_dir, f'body_{book_id}.txt')
+        state_path = os.path.join(out_dir, f'.download_{book_id}.json')
 
-        if os.path.exists(h_path) and os.path.exists(b_path):
+        if not revalidate and datalake.has_book(book_id):
             print(f'Book {book_id} already downloaded, skipping')
-            return
+            return None
 
-        print(f'Downloading book {book_id}...')
         async with sema:
-            async with session.get(url) as resp:
-                assert resp.status == 200
-                data = await resp.read()
+            for attempt in range(retries + 1):
+                try:
+                    print(f'Downloading book {book_id}...')
+                    written = await fetch_once(session, url, book_id, state_path, load_state(state_path))
+                    break
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    if attempt == retries:
+                        raise DownloadError(f'{url} failed after {retries + 1} attempts: {e}') from e
+                    delay = backoff * 2 ** attempt
+                    print(f'Retrying book {book_id} in {delay:.1f}s: {e}')
+                    await asyncio.sleep(delay)
+
+            # awaited inside the semaphore so a slow consumer throttles downloads
+            if written and on_downloaded:
+                result = on_downloaded(book_id)
+                if inspect.isawaitable(result):
+                    await result
 
-        os.makedirs(out_dir, exist_ok=True)
+        return book_id if written else None
 
-        header, body = header_body_split(data.decode('utf-8'))
+    async with aiohttp.ClientSession() as session:
+        results = await asyncio.gather(*[fetch_file(session, url) for url in urls], return_exceptions=True)
 
-        async with aiofile.async_open(h_path, "wb") as h_file, aiofile.async_open(b_path, "wb") as b_file:
-            await h_file.write(header.encode('utf-8'))
-            await b_file.write(body.encode('utf-8')) 
+    downloaded = []
+    for url, result in zip(urls, results):
+        if isinstance(result, BaseException):
+            print(f'Error downloading {url}: {result}')
+        elif result:
+            downloaded.append(result)
+    return downloaded
 
-    async def main():
-        async with aiohttp.ClientSession() as session:
-            tasks = [fetch_file(session, url) for url in urls]
-            await asyncio.gather(*tasks)
 
-    asyncio.run(main())
+def download_books(urls, out_dir=DATALAKE_PATH, **kwargs):
+    return asyncio.run(download_books_async(urls, out_dir, **kwargs))
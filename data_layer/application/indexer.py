@@ -1,19 +1,176 @@
 import re
 import os
+import heapq
 import time
-from typing import Set, Dict, List
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from collections import Counter, deque
+from typing import Set, Dict, Iterator, List, Optional, TextIO, Tuple
 from pathlib import Path
 from application.storage_backends import StorageBackend
+from application.analysis import Analyzer, legacy_analyzer
+from application.cache import LRUCache
+from application.datalake import Datalake, open_datalake
+from application.manifest import BookManifest
+from application.instrumentation import METRICS, Metrics
+from application.lexicon import Lexicon, is_expandable
+from application.postings import decode_positions, encode_positions
+from application.query import (BOOLEAN_PATTERN, AllPlan, AndPlan, ExpandPlan, FieldPlan, OrPlan, PhrasePlan,
+                               PlanNode, QuerySyntaxError, TermsPlan, format_plan, parse_query)
+
+WORD_PATTERN = re.compile(r'\b[a-zA-Z]+\b')
+
+# query words, optionally with * / ? wildcards or a trailing ~ for fuzzy matching
+QUERY_TOKEN_PATTERN = re.compile(r'(?:[^\W\d_]|[*?])+~?')
+
+# "quoted phrases" inside a query, matched word for word on a positional index
+PHRASE_PATTERN = re.compile(r'"([^"]*)"')
+
+# title:, author: and lang: query clauses, the value one word or a "quoted" run of words
+FIELD_PATTERN = re.compile(r'\b(title|author|lang):("[^"]*"|\S+)', re.IGNORECASE)
+
+# language codes are indexed under the names Gutenberg headers use
+LANGUAGE_NAMES = {
+    'en': 'english', 'fr': 'french', 'de': 'german', 'es': 'spanish', 'it': 'italian',
+    'pt': 'portuguese', 'nl': 'dutch', 'fi': 'finnish', 'la': 'latin', 'zh': 'chinese'
+}
+
+# characters read from a body file per step of the streaming tokenizer
+READ_CHUNK_SIZE = 1 << 20
+
+
+def field_terms(field: str, value: str) -> Set[str]:
+    '''terms a title, author or lang value is indexed and queried under
+
+    titles keep the words tokenize_text keeps, authors every name part
+    (de, Wu), languages their name for a known code
+    '''
+    words = WORD_PATTERN.findall(value.lower())
+    if field == 'title':
+        return {word for word in words if len(word) > 2}
+    if field == 'lang':
+        return {LANGUAGE_NAMES.get(word, word) for word in words}
+    return set(words)
+
+
+def book_fields(metadata: Dict) -> Dict[str, Set[str]]:
+    '''secondary index terms of a book per field'''
+    return {
+        'title': field_terms('title', metadata.get('title', '')),
+        'author': field_terms('author', metadata.get('author', '')),
+        'lang': field_terms('lang', metadata.get('language', ''))
+    }
+
+
+def parse_fields(query: str) -> Tuple[Dict[str, Set[str]], str]:
+    '''field filters of a query and the query without them'''
+    filters = {}
+    for field, value in FIELD_PATTERN.findall(query):
+        filters.setdefault(field.lower(), set()).update(field_terms(field.lower(), value.strip('"')))
+    return filters, FIELD_PATTERN.sub(' ', query)
+
 
 class Indexer:
-    def __init__(self, backend: StorageBackend):
+    def __init__(self, backend: StorageBackend, cache_size: int = 1024, cache_ttl: float = 300.0,
+                 manifest_path: Optional[Path] = None, metrics: Metrics = METRICS, positional: bool = False,
+                 analyzer: Optional[Analyzer] = None, datalake: Optional[Datalake] = None,
+                 lexicon_ttl: float = 60.0, generation_check_interval: float = 1.0):
         self.backend = backend
-        self.datalake_path = Path('/app/datalake')
+        self.positional = positional
+        # books and queries go through the same chain, ASCII words of 3+ letters unless configured
+        self.analyzer = analyzer or legacy_analyzer()
+        # loose header / body files unless the datalake was packed or DATALAKE_FORMAT says otherwise
+        self.datalake = datalake or open_datalake()
+        self.manifest_path = manifest_path
+        self.cache = LRUCache(cache_size, cache_ttl)
+        self._cache_generation = None
+        self._generation_checked_at = None
+        self.generation_check_interval = generation_check_interval
+        self.metrics = metrics
+        self._lexicon = None
+        self._lexicon_generation = None
+        self._lexicon_built_at = None
+        # df changes of this indexer's own writes, folded into the lexicon on its next use
+        self._lexicon_deltas = Counter()
+        self.lexicon_ttl = lexicon_ttl
+
+    @property
+    def datalake_path(self) -> Path:
+        return self.datalake.path
+
+    @datalake_path.setter
+    def datalake_path(self, path) -> None:
+        self.datalake = open_datalake(path)
+
+    def __getstate__(self):
+        '''pool workers only run process_book, so the backend connection and metrics stay behind'''
+        state = self.__dict__.copy()
+        state['backend'] = None
+        state['metrics'] = None
+        state['_lexicon'] = None
+        return state
 
     def tokenize_text(self, text: str) -> Set[str]:
-        '''extract words, normalize to lowercase, remove punctuaction'''
-        words = re.findall(r'\b[a-zA-Z]+\b', text.lower())
-        return set(word for word in words if len(word) > 2)
+        '''distinct terms of text as the analyzer indexes them'''
+        return set(self.analyzer.analyze(text))
+
+    def tokenize_stream(self, stream: TextIO, chunk_size: int = READ_CHUNK_SIZE,
+                        timings: Optional[Dict[str, float]] = None,
+                        positions: Optional[Dict[str, List[int]]] = None) -> Tuple[Counter, int]:
+        '''tokenize a text stream chunk by chunk in a single pass
+
+        returns term frequencies for the words tokenize_text would keep plus
+        the whitespace separated word count, holding at most one chunk of
+        text at a time; seconds spent reading and tokenizing are added to
+        timings['read'] and timings['tokenize'] when given
+
+        with positions given, the token offsets of every kept term are
+        appended to positions[term]; offsets count all analyzer tokens,
+        including the short words and stopwords that are not indexed, so
+        phrases keep their gaps
+
+        each chunk is counted per distinct token first and only those go
+        through the analyzer, so stemming costs one memo lookup per
+        distinct token rather than per occurrence
+        '''
+        words = Counter()
+        word_count = 0
+        token_count = 0
+        carry = ''
+        read_seconds = tokenize_seconds = 0.0
+
+        while True:
+            start = time.perf_counter()
+            chunk = stream.read(chunk_size)
+            read_done = time.perf_counter()
+            read_seconds += read_done - start
+            text = carry + chunk
+
+            # cut after the last whitespace so no token straddles two chunks
+            cut = len(text)
+            while chunk and cut and not text[cut - 1].isspace():
+                cut -= 1
+
+            part, carry = text[:cut], text[cut:]
+            if part:
+                word_count += len(part.split())
+                tokens = self.analyzer.tokens(part)
+                counts = Counter(tokens)
+                terms = {token: self.analyzer.term(token) for token in counts}
+                for token, count in counts.items():
+                    if terms[token]:
+                        words[terms[token]] += count
+                if positions is not None:
+                    for offset, token in enumerate(tokens, token_count):
+                        if terms[token]:
+                            positions.setdefault(terms[token], []).append(offset)
+                    token_count += len(tokens)
+            tokenize_seconds += time.perf_counter() - read_done
+
+            if not chunk:
+                if timings is not None:
+                    timings['read'] = timings.get('read', 0.0) + read_seconds
+                    timings['tokenize'] = timings.get('tokenize', 0.0) + tokenize_seconds
+                return words, word_count
 
     def is_book_indexed(self, book_id: str) -> bool:
         '''check if book is already indexed'''
@@ -44,36 +201,52 @@ class Indexer:
         return metadata
 
     def process_book(self, book_id: str) -> Dict:
-        '''process single book and return indexing data'''
-        header_file = self.datalake_path / f'header_{book_id}.txt'
-        body_file = self.datalake_path / f'body_{book_id}.txt'
-
-        if not header_file.exists() or not body_file.exists():
+        '''process single book and return indexing data
+
+        per stage seconds travel with the result under stage_seconds, so
+        timings taken in pool workers reach the metrics of the writer
+        '''
+        timings = {}
+        start = time.perf_counter()
+        if not self.datalake.has_book(book_id):
             raise FileNotFoundError(f'Missing files for book {book_id}')
 
-        with open(header_file, 'r', encoding='utf-8') as f:
-            header_content = f.read().strip()
+        header_content = self.datalake.read_header(book_id).strip()
+        timings['read'] = time.perf_counter() - start
 
-        with open(body_file, 'r', encoding='utf-8') as f:
-            body_content = f.read()
+        positions = {} if self.positional else None
+        with self.datalake.open_body(book_id) as f:
+            term_freqs, word_count = self.tokenize_stream(f, timings=timings, positions=positions)
 
+        start = time.perf_counter()
         metadata = self.extract_metadata_from_header(header_content)
 
-        all_words = self.tokenize_text(body_content)
-        title_words = self.tokenize_text(metadata['title'])
+        title_words = field_terms('title', metadata['title'])
+        timings['extract_metadata'] = time.perf_counter() - start
 
-        return {
+        book_data = {
             'book_id': book_id,
             'title': metadata['title'],
             'author': metadata['author'],
             'language': metadata['language'],
-            'all_words': all_words,
+            'all_words': set(term_freqs),
+            'term_freqs': dict(term_freqs),
             'title_words': title_words,
-            'word_count': len(body_content.split())
+            'word_count': word_count,
+            'stage_seconds': timings
         }
+        if positions is not None:
+            start = time.perf_counter()
+            book_data['positions'] = {word: encode_positions(offsets) for word, offsets in positions.items()}
+            timings['encode_positions'] = time.perf_counter() - start
+        return book_data
 
     def index_book(self, book_data: Dict):
-        '''index a single book using backend interface'''
+        '''index a single book using backend interface
+
+        a book indexed before is diffed against its forward index, so only
+        postings of added, removed or recounted words are written
+        '''
         book_id = book_data['book_id']
 
         metadata = {
@@ -83,66 +256,546 @@ class Indexer:
             'word_count': book_data['word_count'],
             'unique_words': len(book_data['all_words'])
         }
-        self.backend.store_book_metadata(book_id, metadata)
-
-        for word in book_data['all_words']:
-            self.backend.add_word_to_index(word, book_id)
-
-    def index_all_books(self, force_reindex: bool = False):
-        '''index all books, reindex if specified'''
-        book_files = list(self.datalake_path.glob('header_*.txt'))
-        book_ids = [f.stem.replace('header_', '') for f in book_files]
+        term_freqs = book_data.get('term_freqs') or {}
+        term_freqs = {word: term_freqs.get(word, 1) for word in book_data['all_words']}
+        fields = book_fields(metadata)
+        if 'title_words' in book_data:
+            fields['title'] = set(book_data['title_words'])
+        with self.metrics.timer('stage_seconds', stage='backend_write'):
+            previous = self.backend.get_book_words(book_id)
+            changed = {word: tf for word, tf in term_freqs.items() if previous.get(word) != tf}
+            removed = previous.keys() - term_freqs.keys()
+
+            self.backend.store_book_metadata(book_id, metadata)
+            self.backend.store_book_fields(book_id, fields)
+            if changed:
+                self.backend.add_book_postings(book_id, list(changed), changed)
+            if removed:
+                self.backend.remove_book_postings(book_id, sorted(removed))
+            if 'positions' in book_data:
+                self.backend.add_book_positions(book_id, book_data['positions'])
+        self.cache.clear()
+        if self._lexicon is not None:
+            self._lexicon_deltas.update(word for word in changed if word not in previous)
+            self._lexicon_deltas.subtract(removed)
+
+        for stage, seconds in book_data.get('stage_seconds', {}).items():
+            self.metrics.observe('stage_seconds', seconds, stage=stage)
+        self.metrics.incr('books_indexed_total')
+
+    def index_all_books(self, force_reindex: bool = False, workers: int = 1,
+                        max_in_flight: Optional[int] = None):
+        '''index new and changed books, reindex everything if specified
+
+        the manifest of indexed file fingerprints decides what changed, so a
+        run only stats the datalake and never lists the backend unless the
+        manifest and backend disagree on the number of indexed books
+
+        with workers > 1 books are tokenized in a process pool while this
+        process stays the single backend writer; at most max_in_flight
+        books (default 2 per worker) are processed or waiting to be written
+        '''
+        manifest = self.open_manifest()
 
         if not force_reindex:
-            indexed_books = self.get_indexed_books()
-            books_to_index = [bid for bid in book_ids if bid not in indexed_books]
-            skipped_count = len(book_ids) - len(books_to_index)
+            self._reconcile_manifest(manifest)
+            new_books, changed_books, skipped_count = manifest.scan(self.datalake)
 
-            print(f'Found {len(book_ids)} books total')
+            print(f'Found {len(new_books) + len(changed_books) + skipped_count} books total')
             print(f'Skipping {skipped_count} already indexed')
 
-            print(f'Indexing {len(books_to_index)} new books')
+            print(f'Indexing {len(new_books)} new books')
+            if changed_books:
+                print(f'Reindexing {len(changed_books)} changed books')
         else:
-            books_to_index = book_ids
-            print(f'Force reindexing all {len(book_ids)} books')
+            manifest.entries = {}
+            new_books, changed_books, _ = manifest.scan(self.datalake)
+            print(f'Force reindexing all {len(new_books)} books')
 
-        if not books_to_index:
+        fingerprints = {**new_books, **changed_books}
+        if not fingerprints:
             print(f'No new books to index!!')
+            manifest.save()
             return
 
-        for i, book_id in enumerate(books_to_index, 1):
-            try:
-                book_data = self.process_book(book_id)
-                self.index_book(book_data)
-                print(f'Indexed book {i}/{len(books_to_index)}: {book_id}')
-            except Exception as e:
-                print(f'Error indexing book {book_id}: {e}')
-
+        try:
+            for book_id in self._index_books(list(fingerprints), workers, max_in_flight or workers * 2):
+                manifest.record(book_id, fingerprints[book_id], self.datalake)
+        finally:
+            self.backend.flush()
+            manifest.save()
         print('Indexing complete!')
 
+    def reindex_book(self, book_id: str) -> None:
+        '''re-read one book from the datalake and write only what changed'''
+        manifest = self.open_manifest()
+        self.index_book(self.process_book(book_id))
+        self.backend.flush()
+        manifest.record(book_id, manifest.fingerprint(book_id, self.datalake), self.datalake)
+        manifest.save()
+
+    def delete_book(self, book_id: str) -> None:
+        '''remove a book from the index and the manifest, the datalake copy is left alone'''
+        manifest = self.open_manifest()
+        if self._lexicon is not None:
+            self._lexicon_deltas.subtract(self.backend.get_book_words(book_id).keys())
+        self.backend.delete_book(book_id)
+        self.backend.flush()
+        self.cache.clear()
+        manifest.discard(book_id)
+        manifest.save()
+
+    def open_manifest(self) -> BookManifest:
+        '''the manifest of books indexed into this backend'''
+        return BookManifest(self.manifest_path or
+                            self.datalake_path / f'.manifest_{type(self.backend).__name__.lower()}.json')
+
+    def _reconcile_manifest(self, manifest: BookManifest):
+        '''align the manifest with a backend that was rebuilt or indexed by another process'''
+        if self.backend.get_stats()['indexed_books'] == len(manifest):
+            return
+
+        indexed_books = self.get_indexed_books()
+        manifest.retain(indexed_books)
+        new_books, _, _ = manifest.scan(self.datalake)
+        for book_id in indexed_books & new_books.keys():
+            manifest.record(book_id, new_books[book_id], self.datalake)
+
+    def _index_books(self, books_to_index: List[str], workers: int, max_in_flight: int) -> Iterator[str]:
+        '''index the given books, yielding each book_id once it is written'''
+        if workers <= 1:
+            for i, book_id in enumerate(books_to_index, 1):
+                try:
+                    book_data = self.process_book(book_id)
+                    self.index_book(book_data)
+                    print(f'Indexed book {i}/{len(books_to_index)}: {book_id}')
+                except Exception as e:
+                    print(f'Error indexing book {book_id}: {e}')
+                    continue
+                yield book_id
+            return
+
+        # tokenize in a process pool, write results from this process as they complete
+        book_iter = iter(books_to_index)
+        pending = {}
+        i = 0
+
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            while True:
+                while len(pending) < max_in_flight:
+                    book_id = next(book_iter, None)
+                    if book_id is None:
+                        break
+                    pending[pool.submit(self.process_book, book_id)] = book_id
+
+                if not pending:
+                    break
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    book_id = pending.pop(future)
+                    i += 1
+                    try:
+                        self.index_book(future.result())
+                        print(f'Indexed book {i}/{len(books_to_index)}: {book_id}')
+                    except Exception as e:
+                        print(f'Error indexing book {book_id}: {e}')
+                        continue
+                    yield book_id
+
+    def _sync_cache(self):
+        '''drop cached results once the backend generation shows an index write
+
+        this indexer's own writes clear the cache as they happen, so the
+        generation, which only tells about writes of other processes, is
+        polled at most every generation_check_interval seconds
+        '''
+        now = time.monotonic()
+        if self._generation_checked_at is not None and \
+                now - self._generation_checked_at < self.generation_check_interval:
+            return
+        self._generation_checked_at = now
+        generation = self.backend.get_generation()
+        if generation != self._cache_generation:
+            if self._cache_generation is not None:
+                self.cache.clear()
+            self._cache_generation = generation
+
+    def _search_word_cached(self, word: str) -> frozenset:
+        postings = self.cache.get(('term', word))
+        if postings is None:
+            postings = frozenset(self.backend.search_word(word))
+            self.cache.put(('term', word), postings)
+        return postings
+
+    def get_lexicon(self) -> Lexicon:
+        '''sorted vocabulary of the backend
+
+        this indexer's own writes are applied to it incrementally; writes of
+        other processes show up once it is lexicon_ttl seconds old and the
+        backend generation moved, which is when the vocabulary is scanned again
+        '''
+        now = time.monotonic()
+        if self._lexicon is None or now - self._lexicon_built_at >= self.lexicon_ttl:
+            generation = self.backend.get_generation()
+            if self._lexicon is None or generation != self._lexicon_generation:
+                self._lexicon = Lexicon(self.backend.iter_vocabulary())
+                self._lexicon_generation = generation
+                self._lexicon_deltas.clear()
+            self._lexicon_built_at = now
+        if self._lexicon_deltas:
+            self._lexicon = self._lexicon.updated(self._lexicon_deltas)
+            self._lexicon_deltas.clear()
+        return self._lexicon
+
+    def autocomplete(self, prefix: str, k: int = 10) -> List[Tuple[str, int]]:
+        '''the k indexed words starting with prefix that occur in most books'''
+        return self.get_lexicon().autocomplete(prefix.lower(), k)
+
+    def _search_expanded(self, tokens: List[str]) -> List[str]:
+        '''books matching every token, wildcard and fuzzy tokens matching any of their expansions'''
+        tokens = sorted({token if is_expandable(token) else self.analyzer.term(token) for token in tokens} - {None})
+        if not tokens:
+            return []
+
+        self._sync_cache()
+        key = ('expanded', tuple(tokens))
+        result_books = self.cache.get(key)
+        if result_books is None:
+            lexicon = self.get_lexicon()
+            groups = [lexicon.expand(token) if is_expandable(token) else [token] for token in tokens]
+            if not all(groups):
+                result_books = frozenset()
+            else:
+                postings = self.backend.search_word_batch(sorted({term for group in groups for term in group}))
+                result_books = None
+                for group in groups:
+                    matches = set().union(*(postings[term] for term in group))
+                    result_books = matches if result_books is None else result_books & matches
+                    if not result_books:
+                        break
+                result_books = frozenset(result_books)
+            self.cache.put(key, result_books)
+
+        return list(result_books)
+
+    def _candidate_positions(self, words: List[str],
+                             within: Optional[Set[str]] = None) -> Dict[str, Dict[str, List[int]]]:
+        '''decoded positions per book of the books (among within, when given) containing every word
+
+        books are intersected on the postings first, so positions are only
+        fetched and decoded for the survivors
+        '''
+        if within is not None and not within:
+            return {}
+        candidates = self.backend.search_words(words) if len(words) > 1 else self._search_word_cached(words[0])
+        if within is not None:
+            candidates = candidates & within
+        if not candidates:
+            return {}
+        book_ids = sorted(candidates)
+        blobs = self.backend.get_positions(book_ids, words)
+        by_book = {}
+        for (book_id, word), blob in blobs.items():
+            by_book.setdefault(book_id, {})[word] = decode_positions(blob)
+        return {book_id: offsets for book_id, offsets in by_book.items() if len(offsets) == len(words)}
+
+    def search_phrase(self, phrase: str, within: Optional[Set[str]] = None) -> List[str]:
+        '''books containing phrase word for word, needs a positional index
+
+        short words and stopwords are not indexed but still hold their
+        place, so "pride and prejudice" matches pride, any one word, prejudice;
+        given within, only those books are matched and their positions decoded
+        '''
+        tokens = self.analyzer.tokens(phrase)
+        terms = [(offset, word) for offset, word in enumerate(map(self.analyzer.term, tokens)) if word]
+        if not terms:
+            return []
+
+        with self.metrics.timer('stage_seconds', stage='search_phrase'):
+            self._sync_cache()
+            key = ('phrase', tuple(tokens))
+            result_books = self.cache.get(key)
+            if result_books is None:
+                words = sorted({word for _, word in terms})
+                result_books = set()
+                for book_id, positions in self._candidate_positions(words, within).items():
+                    # anchor on the rarest word, probe the others at their offset from it
+                    anchor_offset, anchor = min(terms, key=lambda term: len(positions[term[1]]))
+                    others = [(offset - anchor_offset, set(positions[word]))
+                              for offset, word in terms if (offset, word) != (anchor_offset, anchor)]
+                    if any(all(p + delta in offsets for delta, offsets in others) for p in positions[anchor]):
+                        result_books.add(book_id)
+                result_books = frozenset(result_books)
+                # a result restricted to within is not the phrase's result, it is not cached
+                if within is None:
+                    self.cache.put(key, result_books)
+            if within is not None:
+                result_books = result_books & within
+
+        return list(result_books)
+
+    def search_near(self, query: str, distance: int) -> List[str]:
+        '''books where every query word occurs within a window of distance + 1 words
+
+        needs a positional index; search_near('whale captain', 3) matches
+        "the whale and the captain" and "captain of the whale"
+        '''
+        words = sorted(self.tokenize_text(query))
+        if not words:
+            return []
+
+        with self.metrics.timer('stage_seconds', stage='search_near'):
+            self._sync_cache()
+            key = ('near', tuple(words), distance)
+            result_books = self.cache.get(key)
+            if result_books is None:
+                result_books = frozenset(
+                    book_id for book_id, positions in self._candidate_positions(words).items()
+                    if self._min_window(positions) <= distance
+                )
+                self.cache.put(key, result_books)
+
+        return list(result_books)
+
+    @staticmethod
+    def _min_window(positions: Dict[str, List[int]]) -> int:
+        '''smallest last - first offset of a window holding every word'''
+        merged = heapq.merge(*([(p, word) for p in offsets] for word, offsets in positions.items()))
+        window = deque()
+        counts = Counter()
+        best = float('inf')
+        for position, word in merged:
+            window.append((position, word))
+            counts[word] += 1
+            while counts[window[0][1]] > 1:
+                counts[window.popleft()[1]] -= 1
+            if len(counts) == len(positions):
+                best = min(best, position - window[0][0])
+        return best
+
     def search_books(self, query: str) -> List[str]:
-        '''search for books containing query'''
+        '''search for books containing query
+
+        frank* and fr?nk match indexed words by pattern, frankenstien~ within
+        one edit; each such word may expand to at most MAX_EXPANSIONS terms;
+        on a positional index "quoted phrases" must match word for word;
+        title:, author: and lang: clauses filter on the book's fields;
+        AND, OR, NOT and parentheses make it a boolean query, see plan_query,
+        and one that does not parse is searched for its words alone
+        '''
+        if BOOLEAN_PATTERN.search(query):
+            return self._search_boolean(query)
+
+        if FIELD_PATTERN.search(query):
+            return self._search_fielded(query)
+
+        if self.positional and '"' in query:
+            return self._search_with_phrases(query)
+
+        tokens = QUERY_TOKEN_PATTERN.findall(query.lower())
+        if any(is_expandable(token) for token in tokens):
+            with self.metrics.timer('stage_seconds', stage='search'):
+                return self._search_expanded(tokens)
+
         words = self.tokenize_text(query)
         if not words:
             return []
 
-        book_sets = [self.backend.search_word(word) for word in words]
-        if not book_sets:
+        with self.metrics.timer('stage_seconds', stage='search'):
+            self._sync_cache()
+            key = ('query', tuple(sorted(words)))
+            result_books = self.cache.get(key)
+            if result_books is None:
+                if len(key[1]) == 1:
+                    result_books = self._search_word_cached(key[1][0])
+                else:
+                    result_books = frozenset(self.backend.search_words(list(key[1])))
+                self.cache.put(key, result_books)
+
+        return list(result_books)
+
+    def _search_with_phrases(self, query: str) -> List[str]:
+        result_books = None
+        for phrase in PHRASE_PATTERN.findall(query):
+            if self.analyzer.tokens(phrase):
+                matches = set(self.search_phrase(phrase))
+                result_books = matches if result_books is None else result_books & matches
+        rest = PHRASE_PATTERN.sub(' ', query).replace('"', ' ')
+        if QUERY_TOKEN_PATTERN.search(rest):
+            matches = set(self.search_books(rest))
+            result_books = matches if result_books is None else result_books & matches
+        return list(result_books or [])
+
+    def _search_fielded(self, query: str) -> List[str]:
+        '''books passing the field filters that match the rest of the query
+
+        filters are resolved first on the small secondary indexes; when they
+        leave fewer books than the rarest query word has postings, only the
+        term frequencies of those books are fetched, not the postings
+        '''
+        filters, rest = parse_fields(query)
+        if not all(filters.values()):
+            return []
+
+        with self.metrics.timer('stage_seconds', stage='search_fielded'):
+            self._sync_cache()
+            filtered = self._search_fields_cached(filters)
+
+        tokens = QUERY_TOKEN_PATTERN.findall(rest.lower())
+        if not filtered or not tokens:
+            return list(filtered)
+        if '"' in rest or any(is_expandable(token) for token in tokens):
+            return list(filtered & set(self.search_books(rest)))
+
+        words = sorted(self.tokenize_text(rest))
+        if not words:
             return []
 
-        result_books = book_sets[0]
-        for book_set in book_sets[1:]:
-            result_books &= book_set
+        with self.metrics.timer('stage_seconds', stage='search_fielded'):
+            key = ('fielded', self._fields_key(filters), tuple(words))
+            result_books = self.cache.get(key)
+            if result_books is None:
+                rarest = min(self.backend.posting_sizes(words).values())
+                if len(filtered) < rarest:
+                    tfs = self.backend.get_term_frequencies(sorted(filtered), words)
+                    matched = Counter(book_id for book_id, _ in tfs)
+                    result_books = frozenset(book_id for book_id, n in matched.items() if n == len(words))
+                elif rarest:
+                    result_books = filtered & self.backend.search_words(words)
+                else:
+                    result_books = frozenset()
+                self.cache.put(key, result_books)
+
+        return list(result_books)
+
+    @staticmethod
+    def _fields_key(filters: Dict[str, Set[str]]) -> Tuple:
+        return 'fields', tuple(sorted((field, tuple(sorted(terms))) for field, terms in filters.items()))
+
+    def _search_fields_cached(self, filters: Dict[str, Set[str]]) -> frozenset:
+        key = self._fields_key(filters)
+        books = self.cache.get(key)
+        if books is None:
+            books = frozenset(self.backend.search_fields(filters))
+            self.cache.put(key, books)
+        return books
+
+    def _compile_query(self, node: Tuple) -> Optional[PlanNode]:
+        '''plan operators of a parsed query, None where the analyzer drops every word'''
+        kind = node[0]
+        if kind == 'term':
+            tokens = QUERY_TOKEN_PATTERN.findall(node[1].lower())
+            plans = [ExpandPlan(token, self.get_lexicon().expand(token)) for token in tokens if is_expandable(token)]
+            words = self.analyzer.analyze(' '.join(token for token in tokens if not is_expandable(token)))
+            if words:
+                plans.append(TermsPlan(words))
+            return self._and_plan(plans, []) if plans else None
+        if kind == 'phrase':
+            words = self.analyzer.analyze(node[1])
+            if not words:
+                return None
+            # without positions a phrase is only its words
+            return PhrasePlan(node[1], words) if self.positional else TermsPlan(words)
+        if kind == 'field':
+            return FieldPlan(node[1], field_terms(node[1], node[2]))
+        if kind == 'or':
+            alternatives = [plan for plan in map(self._compile_query, node[1]) if plan]
+            return alternatives[0] if len(alternatives) == 1 else OrPlan(alternatives) if alternatives else None
+
+        items = node[1] if kind == 'and' else [node]
+        positives = [self._compile_query(item) for item in items if item[0] != 'not']
+        negatives = [self._compile_query(item[1]) for item in items if item[0] == 'not']
+        return self._and_plan([plan for plan in positives if plan], [plan for plan in negatives if plan])
+
+    @staticmethod
+    def _and_plan(positives: List[PlanNode], negatives: List[PlanNode]) -> Optional[PlanNode]:
+        '''plain words of an AND are merged into one backend intersection'''
+        terms = [plan for plan in positives if type(plan) is TermsPlan]
+        positives = [plan for plan in positives if type(plan) is not TermsPlan]
+        if terms:
+            positives.append(TermsPlan([word for plan in terms for word in plan.terms]))
+        if not positives:
+            if not negatives:
+                return None
+            positives = [AllPlan()]
+        if len(positives) == 1 and not negatives:
+            return positives[0]
+        return AndPlan(positives, negatives)
+
+    def plan_query(self, query: str) -> Optional[PlanNode]:
+        '''compile a boolean query into a plan with its cost estimates
+
+        posting sizes of every word and expansion come from one
+        posting_sizes call; field clauses are resolved here, their exact
+        size is their estimate
+        '''
+        plan = self._compile_query(parse_query(query))
+        if plan is None:
+            return None
+        words = sorted(plan.words())
+        plan.estimate_costs(self, self.backend.posting_sizes(words) if words else {})
+        return plan
+
+    def _search_boolean(self, query: str) -> List[str]:
+        with self.metrics.timer('stage_seconds', stage='search_boolean'):
+            self._sync_cache()
+            key = ('boolean', ' '.join(query.split()))
+            result_books = self.cache.get(key)
+            if result_books is None:
+                try:
+                    plan = self.plan_query(query)
+                except QuerySyntaxError:
+                    # a dangling operator or unbalanced ( or ", the words are searched as a plain query
+                    return self.search_books(BOOLEAN_PATTERN.sub(' ', query).replace('"', ' '))
+                result_books = plan.run(self, None) if plan else frozenset()
+                self.cache.put(key, result_books)
 
         return list(result_books)
 
+    def explain(self, query: str, analyze: bool = False) -> str:
+        '''the plan of a boolean query, one operator per line in run order
+
+        with analyze the plan is run, uncached, and each line also shows
+        how the operator matched (postings, probe, ...) and its rows
+        '''
+        self._sync_cache()
+        plan = self.plan_query(query)
+        if plan is None:
+            return 'EMPTY  (est=0)'
+        if analyze:
+            plan.run(self, None)
+        return format_plan(plan, analyze)
+
+    def search_ranked(self, query: str, k: int = 10) -> List[Tuple[str, float]]:
+        '''top-k books containing every query word, ranked by BM25'''
+        words = self.tokenize_text(query)
+        if not words:
+            return []
+
+        with self.metrics.timer('stage_seconds', stage='search_ranked'):
+            self._sync_cache()
+            key = ('ranked', tuple(sorted(words)), k)
+            ranked = self.cache.get(key)
+            if ranked is None:
+                ranked = self.backend.search_ranked(list(key[1]), k)
+                self.cache.put(key, ranked)
+
+        return list(ranked)
+
     def get_book_info(self, book_id: str) -> Dict:
         '''gives book metadata'''
         return self.backend.get_book_metadata(book_id)
 
+    def get_books_info(self, book_ids: List[str]) -> Dict[str, Dict]:
+        '''metadata of a page of results in one backend call, unknown books left out'''
+        return self.backend.get_books_metadata(list(book_ids))
+
     def get_stats(self) -> Dict:
         '''gives indexing statistics'''
-        return self.backend.get_stats()
+        stats = self.backend.get_stats()
+        stats['cache'] = self.cache.stats()
+        return stats
 
     def test_backend_connection(self):
         '''test backend connection'''
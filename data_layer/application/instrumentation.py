@@ -0,0 +1,350 @@
+import bisect
+import cProfile
+import contextvars
+import functools
+import io
+import json
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional, Tuple
+
+# upper bounds in seconds, the last bucket is +Inf
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0)
+
+# StorageBackend methods wrapped by instrument_backend
+BACKEND_METHODS = (
+    'store_book_metadata', 'get_book_metadata', 'is_book_indexed', 'get_indexed_books',
+    'add_word_to_index', 'add_book_postings', 'search_word', 'search_word_batch', 'posting_sizes',
+    'search_words', 'search_ranked', 'get_stats', 'get_generation', 'test_connection', 'flush',
+    'add_book_positions', 'get_positions', 'get_term_frequencies', 'get_book_words', 'remove_book_postings',
+    'delete_book', 'store_book_fields', 'search_fields', 'get_books_metadata', 'bulk_load'
+)
+
+# StorageBackend methods returning lazy iterators, their backend work happens while items are drawn
+BACKEND_ITERATOR_METHODS = ('iter_vocabulary', 'iter_postings')
+
+
+class Histogram:
+    '''cumulative-bucket latency histogram in the Prometheus layout'''
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        '''upper bound of the bucket holding the q-quantile'''
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.max
+
+    def to_dict(self) -> Dict:
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 6),
+            'max': round(self.max, 6),
+            'p50': self.quantile(0.5),
+            'p99': self.quantile(0.99),
+            'buckets': {str(bound): count for bound, count in zip(self.buckets + ('+Inf',), self.counts)}
+        }
+
+
+class Metrics:
+    '''thread-safe registry of labelled counters and histograms
+
+        with METRICS.timer('stage_seconds', stage='tokenize'):
+            ...
+        METRICS.incr('backend_round_trips_total', method='search_word')
+    '''
+
+    def __init__(self, prefix: str = 'datamart'):
+        self.prefix = prefix
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name: str, labels: Dict) -> Tuple:
+        return name, tuple(sorted(labels.items()))
+
+    def incr(self, name: str, value: float = 1, **labels) -> None:
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels) -> None:
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, name: str, **labels) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def counter(self, name: str, **labels) -> float:
+        return self._counters.get(self._key(name, labels), 0)
+
+    def histogram(self, name: str, **labels) -> Optional[Histogram]:
+        return self._histograms.get(self._key(name, labels))
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def to_dict(self) -> Dict:
+        with self._lock:
+            return {
+                'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                             for (name, labels), value in sorted(self._counters.items())],
+                'histograms': [{'name': name, 'labels': dict(labels), **histogram.to_dict()}
+                               for (name, labels), histogram in sorted(self._histograms.items())]
+            }
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), indent=2)
+
+    def to_prometheus(self) -> str:
+        '''text exposition format'''
+        def fmt(labels, **extra):
+            pairs = [f'{k}="{v}"' for k, v in (*labels, *extra.items())]
+            return '{' + ','.join(pairs) + '}' if pairs else ''
+
+        lines = []
+        with self._lock:
+            typed = set()
+            for (name, labels), value in sorted(self._counters.items()):
+                metric = f'{self.prefix}_{name}'
+                if metric not in typed:
+                    lines.append(f'# TYPE {metric} counter')
+                    typed.add(metric)
+                lines.append(f'{metric}{fmt(labels)} {value}')
+
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                metric = f'{self.prefix}_{name}'
+                if metric not in typed:
+                    lines.append(f'# TYPE {metric} histogram')
+                    typed.add(metric)
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                    cumulative += count
+                    lines.append(f'{metric}_bucket{fmt(labels, le=bound)} {cumulative}')
+                lines.append(f'{metric}_sum{fmt(labels)} {histogram.sum}')
+                lines.append(f'{metric}_count{fmt(labels)} {histogram.count}')
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path) -> None:
+        '''JSON to path, Prometheus text next to it with a .prom suffix'''
+        path = str(path)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(self.to_json())
+        with open(path.rsplit('.', 1)[0] + '.prom', 'w', encoding='utf-8') as f:
+            f.write(self.to_prometheus())
+
+
+METRICS = Metrics()
+
+
+class _CountingCursor:
+    '''psycopg2 cursor proxy, every execute is one round-trip'''
+
+    def __init__(self, cursor, on_round_trip):
+        self._cursor = cursor
+        self._on_round_trip = on_round_trip
+
+    def execute(self, *args, **kwargs):
+        self._on_round_trip(1)
+        return self._cursor.execute(*args, **kwargs)
+
+    def executemany(self, query, vars_list):
+        vars_list = list(vars_list)
+        self._on_round_trip(len(vars_list))
+        return self._cursor.executemany(query, vars_list)
+
+    def copy_expert(self, *args, **kwargs):
+        self._on_round_trip(1)
+        return self._cursor.copy_expert(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __enter__(self):
+        self._cursor.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        return self._cursor.__exit__(*exc_info)
+
+
+class _CountingConnection:
+    '''psycopg2 connection proxy handing out counting cursors'''
+
+    def __init__(self, conn, on_round_trip):
+        self._conn = conn
+        self._on_round_trip = on_round_trip
+
+    def cursor(self, *args, **kwargs):
+        return _CountingCursor(self._conn.cursor(*args, **kwargs), self._on_round_trip)
+
+    def commit(self):
+        self._on_round_trip(1)
+        return self._conn.commit()
+
+    def rollback(self):
+        self._on_round_trip(1)
+        return self._conn.rollback()
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+def _count_redis_round_trips(client, on_round_trip) -> None:
+    execute_command = client.execute_command
+    make_pipeline = client.pipeline
+
+    def counted_execute_command(*args, **kwargs):
+        on_round_trip(1)
+        return execute_command(*args, **kwargs)
+
+    def counted_pipeline(*args, **kwargs):
+        pipe = make_pipeline(*args, **kwargs)
+        execute = pipe.execute
+
+        def counted_execute(*a, **kw):
+            if pipe.command_stack:
+                on_round_trip(len(pipe.command_stack))
+            return execute(*a, **kw)
+
+        pipe.execute = counted_execute
+        return pipe
+
+    client.execute_command = counted_execute_command
+    client.pipeline = counted_pipeline
+
+
+def instrument_backend(backend, metrics: Metrics = METRICS):
+    '''count calls, latency, commands and round-trips per StorageBackend method
+
+    wraps the methods on the instance, so the backend keeps its type; Redis
+    round-trips are counted at the client (a pipeline is one round-trip
+    carrying many commands) and PostgreSQL ones per statement and commit;
+    nested calls such as add_word_to_index -> add_book_postings are
+    attributed to the method the caller used, and so are the shard calls
+    of a ShardedBackend, which run in its fan-out threads; iter_vocabulary
+    and iter_postings count the time spent producing their items
+    '''
+    backend_name = type(backend).__name__
+    call_stack = contextvars.ContextVar('backend_call_stack', default=())
+
+    def current_method():
+        stack = call_stack.get()
+        return stack[0] if stack else 'other'
+
+    def on_round_trip(commands):
+        metrics.incr('backend_round_trips_total', backend=backend_name, method=current_method())
+        metrics.incr('backend_commands_total', commands, backend=backend_name, method=current_method())
+
+    def wrap(name, method):
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            token = call_stack.set(call_stack.get() + (name,))
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                call_stack.reset(token)
+                if not call_stack.get():
+                    metrics.incr('backend_calls_total', backend=backend_name, method=name)
+                    metrics.observe('backend_call_seconds', time.perf_counter() - start,
+                                    backend=backend_name, method=name)
+        return wrapper
+
+    def wrap_iterator(name, method):
+        '''timed and attributed only while the next item is produced, not while the caller uses it'''
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            nested = bool(call_stack.get())
+            iterator = None
+            busy = 0.0
+            try:
+                while True:
+                    token = call_stack.set(call_stack.get() + (name,))
+                    start = time.perf_counter()
+                    try:
+                        if iterator is None:
+                            iterator = iter(method(*args, **kwargs))
+                        item = next(iterator)
+                    except StopIteration:
+                        return
+                    finally:
+                        busy += time.perf_counter() - start
+                        call_stack.reset(token)
+                    yield item
+            finally:
+                if not nested:
+                    metrics.incr('backend_calls_total', backend=backend_name, method=name)
+                    metrics.observe('backend_call_seconds', busy, backend=backend_name, method=name)
+        return wrapper
+
+    for name in BACKEND_METHODS:
+        setattr(backend, name, wrap(name, getattr(backend, name)))
+    for name in BACKEND_ITERATOR_METHODS:
+        setattr(backend, name, wrap_iterator(name, getattr(backend, name)))
+
+    for target in (backend, *getattr(backend, 'shards', {}).values()):
+        for attr in ('redis_client', 'raw_client'):
+            client = getattr(target, attr, None)
+            if client is not None:
+                _count_redis_round_trips(client, on_round_trip)
+
+        if getattr(target, 'conn', None) is not None:
+            target.conn = _CountingConnection(target.conn, on_round_trip)
+
+    return backend
+
+
+def profile_book(indexer, book_id: str, path: Optional[str] = None, sort: str = 'cumulative',
+                 limit: int = 30) -> str:
+    '''process and index one book under cProfile, returns the pstats report
+
+    the raw profile is dumped to path when given, for snakeviz / pstats
+    '''
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        indexer.index_book(indexer.process_book(book_id))
+    finally:
+        profiler.disable()
+
+    if path:
+        profiler.dump_stats(path)
+    out = io.StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats(sort).print_stats(limit)
+    return out.getvalue()
@@ -0,0 +1,175 @@
+import bisect
+import heapq
+from array import array
+from fnmatch import fnmatchcase
+from typing import Dict, Iterable, List, Optional, Tuple
+
+WILDCARD_CHARS = '*?'
+FUZZY_SUFFIX = '~'
+
+# terms a single wildcard / fuzzy query token may expand to
+MAX_EXPANSIONS = 64
+
+
+class Lexicon:
+    '''sorted, immutable view of the indexed vocabulary with document frequencies
+
+    terms sit in one sorted array next to an array of their dfs and a
+    segment tree of range-max df positions, so a prefix is a bisected range
+    and its k most frequent terms come out in O(k log n); suffix wildcards
+    use the same layout over reversed terms, built on first use; fuzzy
+    matching probes the edit-distance-1 neighbours of a term by bisection
+    '''
+
+    def __init__(self, vocabulary: Iterable[Tuple[str, int]]):
+        pairs = sorted(vocabulary)
+        self.terms = [term for term, _ in pairs]
+        self.dfs = array('I', (df for _, df in pairs))
+        self._tree = self._build_tree(self.dfs)
+        self._alphabet = ''.join(sorted({c for term in self.terms for c in term}))
+        self._reversed = None
+
+    @staticmethod
+    def _build_tree(dfs: array) -> array:
+        '''node i holds the position of the largest df below it, leaves start at n'''
+        n = len(dfs)
+        tree = array('I', bytes(4 * 2 * n)) if n else array('I')
+        for i in range(n):
+            tree[n + i] = i
+        for i in range(n - 1, 0, -1):
+            left, right = tree[2 * i], tree[2 * i + 1]
+            tree[i] = left if dfs[left] >= dfs[right] else right
+        return tree
+
+    def __len__(self) -> int:
+        return len(self.terms)
+
+    def __contains__(self, term: str) -> bool:
+        return self._index(term) is not None
+
+    def _index(self, term: str) -> Optional[int]:
+        i = bisect.bisect_left(self.terms, term)
+        return i if i < len(self.terms) and self.terms[i] == term else None
+
+    def df(self, term: str) -> int:
+        i = self._index(term)
+        return self.dfs[i] if i is not None else 0
+
+    def prefix_range(self, prefix: str) -> Tuple[int, int]:
+        lo = bisect.bisect_left(self.terms, prefix)
+        hi = bisect.bisect_left(self.terms, prefix + '\U0010ffff', lo)
+        return lo, hi
+
+    def _better(self, i: int, j: Optional[int]) -> bool:
+        '''higher df wins, ties go to the alphabetically first term'''
+        return j is None or self.dfs[i] > self.dfs[j] or (self.dfs[i] == self.dfs[j] and i < j)
+
+    def _range_argmax(self, lo: int, hi: int) -> int:
+        n = len(self.dfs)
+        best = None
+        lo += n
+        hi += n
+        while lo < hi:
+            if lo & 1:
+                if self._better(self._tree[lo], best):
+                    best = self._tree[lo]
+                lo += 1
+            if hi & 1:
+                hi -= 1
+                if self._better(self._tree[hi], best):
+                    best = self._tree[hi]
+            lo >>= 1
+            hi >>= 1
+        return best
+
+    def _top_in_range(self, lo: int, hi: int, k: int) -> List[int]:
+        '''positions of the k largest dfs in [lo, hi), largest first'''
+        if lo >= hi or k <= 0:
+            return []
+        best = self._range_argmax(lo, hi)
+        heap = [(-self.dfs[best], best, lo, hi)]
+        top = []
+        while heap and len(top) < k:
+            _, i, lo, hi = heapq.heappop(heap)
+            top.append(i)
+            for sub_lo, sub_hi in ((lo, i), (i + 1, hi)):
+                if sub_lo < sub_hi:
+                    j = self._range_argmax(sub_lo, sub_hi)
+                    heapq.heappush(heap, (-self.dfs[j], j, sub_lo, sub_hi))
+        return top
+
+    def autocomplete(self, prefix: str, k: int = 10) -> List[Tuple[str, int]]:
+        '''the k most frequent terms starting with prefix'''
+        return [(self.terms[i], self.dfs[i]) for i in self._top_in_range(*self.prefix_range(prefix), k)]
+
+    def expand_prefix(self, prefix: str, limit: int = MAX_EXPANSIONS) -> List[str]:
+        return [term for term, _ in self.autocomplete(prefix, limit)]
+
+    def updated(self, deltas: Dict[str, int]) -> 'Lexicon':
+        '''a copy with document frequency deltas applied, terms whose df drops to 0 left out'''
+        dfs = dict(zip(self.terms, self.dfs))
+        for term, delta in deltas.items():
+            dfs[term] = dfs.get(term, 0) + delta
+        return Lexicon((term, df) for term, df in dfs.items() if df > 0)
+
+    def _reversed_terms(self) -> Tuple[List[str], array]:
+        if self._reversed is None:
+            order = sorted(range(len(self.terms)), key=lambda i: self.terms[i][::-1])
+            self._reversed = ([self.terms[i][::-1] for i in order], array('I', order))
+        return self._reversed
+
+    def expand_wildcard(self, pattern: str, limit: int = MAX_EXPANSIONS) -> List[str]:
+        '''terms matching a * / ? pattern, most frequent first
+
+        only the range sharing the pattern's literal prefix (or suffix, when
+        that is longer) is examined; a pattern with neither, like * or *a*,
+        would scan the whole vocabulary and matches nothing
+        '''
+        first = min(pattern.find(c) if c in pattern else len(pattern) for c in WILDCARD_CHARS)
+        last = max(pattern.rfind(c) for c in WILDCARD_CHARS)
+        prefix, suffix = pattern[:first], pattern[last + 1:]
+        if not prefix and not suffix:
+            return []
+
+        if pattern == prefix + '*':
+            return self.expand_prefix(prefix, limit)
+
+        if len(prefix) >= len(suffix):
+            lo, hi = self.prefix_range(prefix)
+            candidates = range(lo, hi)
+        else:
+            reversed_terms, order = self._reversed_terms()
+            rev = suffix[::-1]
+            lo = bisect.bisect_left(reversed_terms, rev)
+            hi = bisect.bisect_left(reversed_terms, rev + '\U0010ffff', lo)
+            candidates = (order[j] for j in range(lo, hi))
+
+        matches = [i for i in candidates if fnmatchcase(self.terms[i], pattern)]
+        matches.sort(key=lambda i: (-self.dfs[i], self.terms[i]))
+        return [self.terms[i] for i in matches[:limit]]
+
+    def _edits1(self, term: str) -> set:
+        splits = [(term[:i], term[i:]) for i in range(len(term) + 1)]
+        deletes = {a + b[1:] for a, b in splits if b}
+        transposes = {a + b[1] + b[0] + b[2:] for a, b in splits if len(b) > 1}
+        replaces = {a + c + b[1:] for a, b in splits if b for c in self._alphabet}
+        inserts = {a + c + b for a, b in splits for c in self._alphabet}
+        return deletes | transposes | replaces | inserts
+
+    def fuzzy(self, term: str, limit: int = MAX_EXPANSIONS) -> List[str]:
+        '''indexed terms within edit distance 1 (Damerau) of term, most frequent first'''
+        matches = [(self.df(candidate), candidate) for candidate in self._edits1(term) | {term}]
+        matches = sorted((m for m in matches if m[0]), key=lambda m: (-m[0], m[1]))
+        return [candidate for _, candidate in matches[:limit]]
+
+    def expand(self, token: str, limit: int = MAX_EXPANSIONS) -> List[str]:
+        '''terms a query token stands for: frank*, fr?nk, frankenstien~ or a plain term'''
+        if token.endswith(FUZZY_SUFFIX):
+            return self.fuzzy(token[:-1], limit)
+        if any(c in token for c in WILDCARD_CHARS):
+            return self.expand_wildcard(token, limit)
+        return [token] if token in self else []
+
+
+def is_expandable(token: str) -> bool:
+    return token.endswith(FUZZY_SUFFIX) or any(c in token for c in WILDCARD_CHARS)
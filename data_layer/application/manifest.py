@@ -0,0 +1,84 @@
+import json
+import os
+from pathlib import Path
+from typing import Dict, Iterable, Tuple
+
+from application.datalake import Datalake
+
+
+class BookManifest:
+    '''book_id -> size / mtime / content hash of the files that were last indexed
+
+    a datalake scan only stats files (or reads the pack index); contents
+    are hashed when size or mtime moved, so unchanged books cost one stat per file and re-downloads
+    with identical contents are not reindexed
+    '''
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.entries = {}
+        if self.path.exists():
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, book_id: str) -> bool:
+        return book_id in self.entries
+
+    def scan(self, datalake: Datalake) -> Tuple[Dict[str, Dict], Dict[str, Dict], int]:
+        '''compare the datalake with the manifest
+
+        returns (new, changed, unchanged_count) where new and changed map
+        book_id to the fingerprint to record once the book is indexed
+        '''
+        new, changed = {}, {}
+        unchanged = 0
+        for book_id, fingerprint in datalake.scan().items():
+            if fingerprint is None:
+                new[book_id] = None
+                continue
+
+            previous = self.entries.get(book_id)
+            if previous is None:
+                new[book_id] = fingerprint
+                continue
+            if previous['size'] == fingerprint['size'] and previous['mtime_ns'] == fingerprint['mtime_ns']:
+                unchanged += 1
+                continue
+
+            fingerprint['sha256'] = datalake.digest(book_id)
+            if fingerprint['sha256'] == previous.get('sha256'):
+                # touched but identical, remember the new mtime only
+                self.entries[book_id] = fingerprint
+                unchanged += 1
+            else:
+                changed[book_id] = fingerprint
+
+        return new, changed, unchanged
+
+    def fingerprint(self, book_id: str, datalake: Datalake) -> Dict:
+        '''fingerprint of a single book, for books indexed outside scan'''
+        return datalake.fingerprint(book_id)
+
+    def record(self, book_id: str, fingerprint: Dict, datalake: Datalake) -> None:
+        if fingerprint is None:
+            return
+        if 'sha256' not in fingerprint:
+            fingerprint = dict(fingerprint, sha256=datalake.digest(book_id))
+        self.entries[book_id] = fingerprint
+
+    def discard(self, book_id: str) -> None:
+        self.entries.pop(book_id, None)
+
+    def retain(self, book_ids: Iterable[str]) -> None:
+        '''forget books the backend no longer has'''
+        keep = set(book_ids)
+        self.entries = {book_id: e for book_id, e in self.entries.items() if book_id in keep}
+
+    def save(self) -> None:
+        tmp_path = self.path.with_suffix('.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_path, self.path)
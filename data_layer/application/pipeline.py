@@ -1,42 +1,178 @@
-from .downloader import download_books
+from .downloader import download_books_async
 from .indexer import Indexer
-from .storage_backends import RedisBackend, PostgreSQLBackend
+from .analysis import get_analyzer
+from .storage_backends import StorageBackend, RedisBackend, BitmapRedisBackend, PostgreSQLBackend, CompactPostgreSQLBackend, EmbeddedBackend, ShardedBackend
+from .instrumentation import METRICS, instrument_backend
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, List, Optional
+import asyncio
+import time
 import sys
 import os
 
-def run_pipeline(backend_name='redis'):
-    """Run the data pipeline with specified backend"""
+BOOK_URLS = [
+   "https://www.gutenberg.org/cache/epub/1342/pg1342.txt",
+   "https://www.gutenberg.org/cache/epub/84/pg84.txt",
+   "https://www.gutenberg.org/cache/epub/11/pg11.txt",
+   "https://www.gutenberg.org/cache/epub/74/pg74.txt",
+   "https://www.gutenberg.org/cache/epub/1080/pg1080.txt"
+]
 
-    urls = [
-       "https://www.gutenberg.org/cache/epub/1342/pg1342.txt",
-       "https://www.gutenberg.org/cache/epub/84/pg84.txt",
-       "https://www.gutenberg.org/cache/epub/11/pg11.txt",
-       "https://www.gutenberg.org/cache/epub/74/pg74.txt",
-       "https://www.gutenberg.org/cache/epub/1080/pg1080.txt"
-    ]
+# books waiting between two stages before the upstream stage blocks
+STAGE_QUEUE_SIZE = 8
 
-    print(f'Starting pipeline with {backend_name} backend...')
 
-    download_books(urls)
-    print('Book database updated.')
+class StageStats:
+    '''items, errors and busy time of one pipeline stage'''
+
+    def __init__(self, name: str):
+        self.name = name
+        self.items = 0
+        self.errors = 0
+        self.busy = 0.0
+        self.started = None
+        self.finished = None
+
+    def summary(self) -> Dict:
+        wall = (self.finished or time.perf_counter()) - (self.started or time.perf_counter())
+        return {
+            'items': self.items,
+            'errors': self.errors,
+            'busy_seconds': round(self.busy, 3),
+            'wall_seconds': round(wall, 3),
+            'items_per_sec': round(self.items / wall, 2) if wall > 0 else 0.0
+        }
+
+
+async def stream_books(urls: List[str], indexer: Indexer, workers: Optional[int] = None,
+                       queue_size: int = STAGE_QUEUE_SIZE, **download_kwargs) -> Dict[str, Dict]:
+    '''download -> tokenize -> write, each book moving on as soon as its stage is done
+
+    stages are joined by bounded queues, so a slow tokenizer holds up
+    downloads and a slow backend holds up tokenizing; books are tokenized
+    in a process pool and written by a single writer thread that owns the
+    backend connection; returns per stage throughput counters
+    '''
+    workers = workers or os.cpu_count() or 1
+    loop = asyncio.get_running_loop()
+    stats = {name: StageStats(name) for name in ('download', 'tokenize', 'write')}
+    downloaded = asyncio.Queue(queue_size)
+    tokenized = asyncio.Queue(queue_size)
+    manifest = indexer.open_manifest()
+
+    async def on_downloaded(book_id):
+        stats['download'].items += 1
+        await downloaded.put(book_id)
+
+    async def download():
+        stats['download'].started = time.perf_counter()
+        try:
+            await download_books_async(urls, indexer.datalake_path, on_downloaded=on_downloaded,
+                                       datalake=indexer.datalake, **download_kwargs)
+        finally:
+            stats['download'].finished = time.perf_counter()
+            stats['download'].busy = stats['download'].finished - stats['download'].started
+            for _ in range(workers):
+                await downloaded.put(None)
+
+    async def tokenize(pool):
+        while (book_id := await downloaded.get()) is not None:
+            stage = stats['tokenize']
+            stage.started = stage.started or time.perf_counter()
+            start = time.perf_counter()
+            try:
+                book_data = await loop.run_in_executor(pool, indexer.process_book, book_id)
+            except Exception as e:
+                print(f'Error indexing book {book_id}: {e}')
+                stage.errors += 1
+                continue
+            finally:
+                stage.busy += time.perf_counter() - start
+                stage.finished = time.perf_counter()
+            stage.items += 1
+            await tokenized.put(book_data)
+
+    async def write(writer):
+        stage = stats['write']
+        while (book_data := await tokenized.get()) is not None:
+            stage.started = stage.started or time.perf_counter()
+            start = time.perf_counter()
+            book_id = book_data['book_id']
+            try:
+                await loop.run_in_executor(writer, indexer.index_book, book_data)
+                manifest.record(book_id, manifest.fingerprint(book_id, indexer.datalake), indexer.datalake)
+                stage.items += 1
+                print(f'Indexed book {stage.items}: {book_id}')
+            except Exception as e:
+                print(f'Error indexing book {book_id}: {e}')
+                stage.errors += 1
+            finally:
+                stage.busy += time.perf_counter() - start
+                stage.finished = time.perf_counter()
 
+    with ProcessPoolExecutor(max_workers=workers) as pool, ThreadPoolExecutor(max_workers=1) as writer:
+        writer_task = asyncio.ensure_future(write(writer))
+        try:
+            await asyncio.gather(download(), *[tokenize(pool) for _ in range(workers)])
+            await tokenized.put(None)
+            await writer_task
+        finally:
+            writer_task.cancel()
+            await loop.run_in_executor(writer, indexer.backend.flush)
+            manifest.save()
+
+    return {name: stage.summary() for name, stage in stats.items()}
+
+
+def create_backend(backend_name='redis') -> StorageBackend:
+    """Backend for a BACKEND_TYPE name, Redis for unknown names"""
     if backend_name.lower() == 'redis':
         backend = RedisBackend()
         print('Using Redis datamart')
+    elif backend_name.lower() == 'redis-bitmap':
+        backend = BitmapRedisBackend()
+        print('Using Redis datamart (bitmap postings)')
     elif backend_name.lower() == 'postgres':
         backend = PostgreSQLBackend()
         print('Using PostgreSQL datamart')
+    elif backend_name.lower() == 'postgres-compact':
+        backend = CompactPostgreSQLBackend()
+        print('Using PostgreSQL datamart (compact schema)')
+    elif backend_name.lower() == 'embedded':
+        backend = EmbeddedBackend()
+        print('Using embedded on-disk datamart')
+    elif backend_name.lower() == 'sharded':
+        # comma separated redis://, postgresql:// and embedded:// urls, one per shard
+        backend = ShardedBackend.from_urls(os.getenv('SHARD_URLS', 'redis://redis:6379/0').split(','))
+        print(f'Using sharded datamart over {len(backend.shards)} shards')
     else:
         print(f'Unknown backend: {backend_name}. Using Redis as default.')
         backend = RedisBackend()
+    return backend
+
+
+def run_pipeline(backend_name='redis', urls=None, workers=None, metrics_path=None, positional=False,
+                 analyzer='legacy'):
+    """Run the data pipeline with specified backend"""
+
+    print(f'Starting pipeline with {backend_name} backend...')
 
-    indexer = Indexer(backend)
+    backend = create_backend(backend_name)
+    # the same analyzer has to be used by whatever queries this index
+    indexer = Indexer(instrument_backend(backend), positional=positional, analyzer=get_analyzer(analyzer))
     if not indexer.test_backend_connection():
         print(f'Failed to connect to {backend_name} backend!')
         return False
 
-    print('Indexing books (skips already indexed)')
-    indexer.index_all_books()
+    print('Downloading and indexing books as they arrive')
+    stage_stats = asyncio.run(stream_books(urls or BOOK_URLS, indexer, workers))
+    for name, stage in stage_stats.items():
+        print(f'{name}: {stage["items"]} books, {stage["errors"]} errors, '
+              f'{stage["busy_seconds"]}s busy, {stage["items_per_sec"]} books/s')
+
+    # books already in the datalake that were not downloaded this run (not modified, earlier runs)
+    print('Indexing remaining books (skips already indexed)')
+    indexer.index_all_books(workers=workers or 1)
 
     stats = indexer.get_stats()
     print(f'\nPipeline complete!')
@@ -44,6 +180,10 @@ def run_pipeline(backend_name='redis'):
     print(f'Total books indexed: {stats["total_books"]}')
     print(f'Unique words: {stats["unique_words"]}')
 
+    if metrics_path:
+        METRICS.write(metrics_path)
+        print(f'Metrics written to {metrics_path}')
+
 if __name__ == '__main__':
     backend = 'redis'
     if len(sys.argv) > 1:
@@ -52,4 +192,6 @@ if __name__ == '__main__':
     backend = os.getenv('BACKEND_TYPE', backend)
 
     print(f'Running pipeline with backend: {backend}')
-    run_pipeline(backend)
+    run_pipeline(backend, metrics_path=os.getenv('METRICS_PATH'),
+                 positional=os.getenv('POSITIONAL_INDEX', '').lower() in ('1', 'true', 'yes'),
+                 analyzer=os.getenv('ANALYZER', 'legacy'))
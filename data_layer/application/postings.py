@@ -0,0 +1,229 @@
+import itertools
+import mmap
+import os
+import struct
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# segment layout (little endian):
+#   header       magic(8) term_count(u32) reserved(u32)
+#   term table   term_count x u64 offset of each term entry, sorted by term bytes
+#   term entries term_len(u16) term df(u32) postings_offset(u64) postings_len(u32)
+#   postings     varint pairs (docid delta, tf) per term
+SEGMENT_MAGIC = b'BDSEG001'
+_HEADER = struct.Struct('<8sII')
+_TABLE_SLOT = struct.Struct('<Q')
+_TERM_LEN = struct.Struct('<H')
+_TERM_INFO = struct.Struct('<IQI')
+
+
+def encode_varint(value: int, out: bytearray) -> None:
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def decode_varints(data) -> List[int]:
+    values = []
+    value = shift = 0
+    for byte in data:
+        value |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            values.append(value)
+            value = shift = 0
+    return values
+
+
+def encode_positions(positions: List[int]) -> bytes:
+    '''delta/varint encode ascending token positions'''
+    out = bytearray()
+    previous = 0
+    for position in positions:
+        encode_varint(position - previous, out)
+        previous = position
+    return bytes(out)
+
+
+def decode_positions(data) -> List[int]:
+    return list(itertools.accumulate(decode_varints(data)))
+
+
+def encode_postings(postings: Dict[int, int]) -> bytes:
+    '''delta-encode sorted docids, each followed by its term frequency'''
+    out = bytearray()
+    previous = 0
+    for docid in sorted(postings):
+        encode_varint(docid - previous, out)
+        encode_varint(postings[docid], out)
+        previous = docid
+    return bytes(out)
+
+
+def decode_postings(data) -> Dict[int, int]:
+    values = decode_varints(data)
+    postings = {}
+    docid = 0
+    for i in range(0, len(values), 2):
+        docid += values[i]
+        postings[docid] = values[i + 1]
+    return postings
+
+
+# set bit offsets of every byte value, most significant bit first as in Redis SETBIT
+_BYTE_BITS = [tuple(bit for bit in range(8) if value & (0x80 >> bit)) for value in range(256)]
+
+
+def bitmap_docids(data: bytes) -> List[int]:
+    '''docids whose bit is set in a Redis bitmap'''
+    docids = []
+    for i, byte in enumerate(data):
+        if byte:
+            base = i << 3
+            docids.extend(base + bit for bit in _BYTE_BITS[byte])
+    return docids
+
+
+def bitmap_contains(data: bytes, docid: int) -> bool:
+    index = docid >> 3
+    return index < len(data) and bool(data[index] & (0x80 >> (docid & 7)))
+
+
+def write_segment(path: Path, index: Dict[str, Dict[int, int]]) -> None:
+    '''write a term -> {docid: tf} mapping as one immutable segment file'''
+    terms = sorted((word.encode('utf-8'), word) for word in index if index[word])
+    table_start = _HEADER.size
+    entries_start = table_start + _TABLE_SLOT.size * len(terms)
+
+    table = bytearray()
+    entries = bytearray()
+    blobs = []
+    entry_sizes = sum(_TERM_LEN.size + len(raw) + _TERM_INFO.size for raw, _ in terms)
+    postings_offset = entries_start + entry_sizes
+
+    for raw, word in terms:
+        blob = encode_postings(index[word])
+        table += _TABLE_SLOT.pack(entries_start + len(entries))
+        entries += _TERM_LEN.pack(len(raw)) + raw
+        entries += _TERM_INFO.pack(len(index[word]), postings_offset, len(blob))
+        postings_offset += len(blob)
+        blobs.append(blob)
+
+    tmp_path = path.with_suffix('.tmp')
+    with open(tmp_path, 'wb') as f:
+        f.write(_HEADER.pack(SEGMENT_MAGIC, len(terms), 0))
+        f.write(table)
+        f.write(entries)
+        for blob in blobs:
+            f.write(blob)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+# per-book positions file: entry_count(u32), then per entry
+#   word_len(u16) word blob_len(u32) blob (encode_positions)
+_POSITIONS_COUNT = struct.Struct('<I')
+_POSITIONS_BLOB_LEN = struct.Struct('<I')
+
+
+def write_positions_file(path: Path, positions: Dict[str, bytes]) -> None:
+    tmp_path = Path(f'{path}.tmp')
+    with open(tmp_path, 'wb') as f:
+        f.write(_POSITIONS_COUNT.pack(len(positions)))
+        for word, blob in positions.items():
+            raw = word.encode('utf-8')
+            f.write(_TERM_LEN.pack(len(raw)) + raw + _POSITIONS_BLOB_LEN.pack(len(blob)) + blob)
+    os.replace(tmp_path, path)
+
+
+def read_positions_file(path: Path, words) -> Dict[str, bytes]:
+    '''encoded positions of the requested words, skipping over the others'''
+    wanted = {word.encode('utf-8') for word in words}
+    found = {}
+    with open(path, 'rb') as f:
+        data = f.read()
+    count, = _POSITIONS_COUNT.unpack_from(data, 0)
+    offset = _POSITIONS_COUNT.size
+    for _ in range(count):
+        word_len, = _TERM_LEN.unpack_from(data, offset)
+        offset += _TERM_LEN.size
+        raw = data[offset:offset + word_len]
+        offset += word_len
+        blob_len, = _POSITIONS_BLOB_LEN.unpack_from(data, offset)
+        offset += _POSITIONS_BLOB_LEN.size
+        if raw in wanted:
+            found[raw.decode('utf-8')] = data[offset:offset + blob_len]
+            if len(found) == len(wanted):
+                break
+        offset += blob_len
+    return found
+
+
+class SegmentReader:
+    '''read-only view of a segment file through mmap; lookups binary search the term table'''
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.term_count, _ = _HEADER.unpack_from(self._mm, 0)
+        if magic != SEGMENT_MAGIC:
+            raise ValueError(f'{path} is not a postings segment')
+
+    def __len__(self) -> int:
+        return self.term_count
+
+    def _entry(self, i: int) -> Tuple[bytes, int, int, int]:
+        offset, = _TABLE_SLOT.unpack_from(self._mm, _HEADER.size + _TABLE_SLOT.size * i)
+        term_len, = _TERM_LEN.unpack_from(self._mm, offset)
+        offset += _TERM_LEN.size
+        raw = self._mm[offset:offset + term_len]
+        df, postings_offset, postings_len = _TERM_INFO.unpack_from(self._mm, offset + term_len)
+        return raw, df, postings_offset, postings_len
+
+    def _find(self, word: str) -> Optional[Tuple[bytes, int, int, int]]:
+        target = word.encode('utf-8')
+        lo, hi = 0, self.term_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            entry = self._entry(mid)
+            if entry[0] < target:
+                lo = mid + 1
+            elif entry[0] > target:
+                hi = mid
+            else:
+                return entry
+        return None
+
+    def document_frequency(self, word: str) -> int:
+        entry = self._find(word)
+        return entry[1] if entry else 0
+
+    def postings(self, word: str) -> Dict[int, int]:
+        entry = self._find(word)
+        if entry is None:
+            return {}
+        _, _, offset, length = entry
+        return decode_postings(memoryview(self._mm)[offset:offset + length])
+
+    def terms(self) -> Iterator[str]:
+        for i in range(self.term_count):
+            yield self._entry(i)[0].decode('utf-8')
+
+    def vocabulary(self) -> Iterator[Tuple[str, int]]:
+        '''terms with their document frequency, without decoding postings'''
+        for i in range(self.term_count):
+            raw, df, _, _ = self._entry(i)
+            yield raw.decode('utf-8'), df
+
+    def items(self) -> Iterator[Tuple[str, Dict[int, int]]]:
+        for i in range(self.term_count):
+            raw, _, offset, length = self._entry(i)
+            yield raw.decode('utf-8'), decode_postings(memoryview(self._mm)[offset:offset + length])
+
+    def close(self) -> None:
+        self._mm.close()
+        self._file.close()
@@ -0,0 +1,354 @@
+import re
+from abc import ABC, abstractmethod
+from collections import Counter
+from typing import Dict, FrozenSet, List, Optional, Set, Tuple
+
+# a query with an upper case operator or a parenthesis is parsed as a boolean expression
+BOOLEAN_PATTERN = re.compile(r'\b(?:AND|OR|NOT)\b|[()]')
+
+OPERATORS = ('AND', 'OR', 'NOT')
+
+QUERY_LEXER = re.compile(r'''\s*(?:
+    (?P<paren>[()])
+  | "(?P<phrase>[^"]*)"
+  | (?P<field>title|author|lang):(?P<value>"[^"]*"|[^\s()"]+)
+  | (?P<word>[^\s()"]+)
+)''', re.VERBOSE | re.IGNORECASE)
+
+
+class QuerySyntaxError(ValueError):
+    pass
+
+
+def _lex(query: str) -> List[Tuple]:
+    tokens = []
+    position = 0
+    query = query.rstrip()
+    while position < len(query):
+        match = QUERY_LEXER.match(query, position)
+        if match is None or match.end() == position:
+            raise QuerySyntaxError(f'Unterminated phrase at position {position} of {query!r}')
+        position = match.end()
+        if match.group('paren'):
+            tokens.append(('paren', match.group('paren')))
+        elif match.group('phrase') is not None:
+            tokens.append(('phrase', match.group('phrase')))
+        elif match.group('field'):
+            tokens.append(('field', match.group('field').lower(), match.group('value').strip('"')))
+        elif match.group('word') in OPERATORS:
+            tokens.append(('op', match.group('word')))
+        else:
+            tokens.append(('term', match.group('word')))
+    return tokens
+
+
+def parse_query(query: str) -> Tuple:
+    '''syntax tree of a boolean query
+
+    OR binds loosest, then AND, then NOT; words next to each other are
+    ANDed; operators are upper case, so "pride and prejudice" stays three
+    words; leaves are ('term', word), ('phrase', text) and
+    ('field', field, value), inner nodes ('and', [...]), ('or', [...])
+    and ('not', node)
+    '''
+    tokens = _lex(query)
+    position = 0
+
+    def peek():
+        return tokens[position] if position < len(tokens) else None
+
+    def take():
+        nonlocal position
+        position += 1
+        return tokens[position - 1]
+
+    def parse_or():
+        items = [parse_and()]
+        while peek() == ('op', 'OR'):
+            take()
+            items.append(parse_and())
+        return items[0] if len(items) == 1 else ('or', items)
+
+    def parse_and():
+        items = [parse_not()]
+        while peek() is not None and peek() not in (('op', 'OR'), ('paren', ')')):
+            if peek() == ('op', 'AND'):
+                take()
+            items.append(parse_not())
+        return items[0] if len(items) == 1 else ('and', items)
+
+    def parse_not():
+        token = peek()
+        if token is None:
+            raise QuerySyntaxError(f'Query {query!r} ends where a term was expected')
+        take()
+        if token == ('op', 'NOT'):
+            return 'not', parse_not()
+        if token == ('paren', '('):
+            node = parse_or()
+            if peek() != ('paren', ')'):
+                raise QuerySyntaxError(f'Missing ) in {query!r}')
+            take()
+            return node
+        if token[0] in ('op', 'paren'):
+            raise QuerySyntaxError(f'Unexpected {token[1]} in {query!r}')
+        return token
+
+    if not tokens:
+        raise QuerySyntaxError('Empty query')
+    tree = parse_or()
+    if peek() is not None:
+        raise QuerySyntaxError(f'Unexpected {peek()[1]} in {query!r}')
+    return tree
+
+
+class PlanNode(ABC):
+    '''one operator of a query plan
+
+    estimate is the planner's upper bound on the matching books, from
+    posting sizes; run(indexer, within) returns the matching books among
+    within (all books when None) and records how in method and rows
+    '''
+
+    def __init__(self):
+        self.estimate = None
+        self.method = None
+        self.rows = None
+
+    def children(self) -> List['PlanNode']:
+        return []
+
+    def words(self) -> Set[str]:
+        '''terms whose posting sizes the estimates need'''
+        return set().union(*(child.words() for child in self.children()))
+
+    def estimate_costs(self, indexer, sizes: Dict[str, int]) -> None:
+        for child in self.children():
+            child.estimate_costs(indexer, sizes)
+
+    @abstractmethod
+    def run(self, indexer, within: Optional[FrozenSet[str]]) -> FrozenSet[str]:
+        pass
+
+    def skip(self) -> None:
+        '''not run, an earlier operand already left nothing to match'''
+        self.method = 'skipped'
+        for child in self.children():
+            child.skip()
+
+    @abstractmethod
+    def describe(self) -> str:
+        pass
+
+    def _done(self, method: str, books: FrozenSet[str]) -> FrozenSet[str]:
+        self.method = method
+        self.rows = len(books)
+        return books
+
+
+def _sort_key(node: PlanNode):
+    '''cheapest first, unknown estimates last'''
+    return node.estimate is None, node.estimate or 0
+
+
+def _probe(indexer, within: FrozenSet[str], words: List[str], matches: int) -> FrozenSet[str]:
+    '''books of within having at least matches of words, from their term frequencies'''
+    found = Counter(book_id for book_id, _ in indexer.backend.get_term_frequencies(sorted(within), words))
+    return frozenset(book_id for book_id, n in found.items() if n >= matches)
+
+
+class TermsPlan(PlanNode):
+    '''books containing every word, intersected inside the backend
+
+    within fewer books than the rarest word has postings, only the term
+    frequencies of those books are fetched
+    '''
+
+    def __init__(self, words: List[str]):
+        super().__init__()
+        self.terms = sorted(set(words))
+
+    def words(self) -> Set[str]:
+        return set(self.terms)
+
+    def estimate_costs(self, indexer, sizes: Dict[str, int]) -> None:
+        self.estimate = min(sizes.get(word, 0) for word in self.terms)
+
+    def run(self, indexer, within):
+        if not self.estimate:
+            return self._done('empty', frozenset())
+        if within is not None and len(within) < self.estimate:
+            return self._done('probe', _probe(indexer, within, self.terms, len(self.terms)))
+        if len(self.terms) == 1:
+            books = indexer._search_word_cached(self.terms[0])
+        else:
+            books = frozenset(indexer.backend.search_words(self.terms))
+        return self._done('postings', books if within is None else books & within)
+
+    def describe(self) -> str:
+        return f'TERMS {" ".join(self.terms)}'
+
+
+class ExpandPlan(PlanNode):
+    '''books containing any expansion of a wildcard or fuzzy token'''
+
+    def __init__(self, token: str, expansions: List[str]):
+        super().__init__()
+        self.token = token
+        self.expansions = sorted(expansions)
+
+    def words(self) -> Set[str]:
+        return set(self.expansions)
+
+    def estimate_costs(self, indexer, sizes: Dict[str, int]) -> None:
+        self.estimate = sum(sizes.get(term, 0) for term in self.expansions)
+
+    def run(self, indexer, within):
+        if not self.estimate:
+            return self._done('empty', frozenset())
+        if within is not None and len(within) < self.estimate:
+            return self._done('probe', _probe(indexer, within, self.expansions, 1))
+        postings = indexer.backend.search_word_batch(self.expansions)
+        books = frozenset().union(*postings.values())
+        return self._done('postings', books if within is None else books & within)
+
+    def describe(self) -> str:
+        return f'EXPAND {self.token} -> {" ".join(self.expansions) or "nothing"}'
+
+
+class PhrasePlan(PlanNode):
+    '''books containing the phrase word for word, on a positional index'''
+
+    def __init__(self, text: str, words: List[str]):
+        super().__init__()
+        self.text = text
+        self.terms = sorted(set(words))
+
+    def words(self) -> Set[str]:
+        return set(self.terms)
+
+    def estimate_costs(self, indexer, sizes: Dict[str, int]) -> None:
+        self.estimate = min(sizes.get(word, 0) for word in self.terms)
+
+    def run(self, indexer, within):
+        if not self.estimate:
+            return self._done('empty', frozenset())
+        return self._done('positions', frozenset(indexer.search_phrase(self.text, within)))
+
+    def describe(self) -> str:
+        return f'PHRASE "{self.text}"'
+
+
+class FieldPlan(PlanNode):
+    '''books whose field holds every term, resolved on the small field index while planning'''
+
+    def __init__(self, field: str, terms: Set[str]):
+        super().__init__()
+        self.field = field
+        self.terms = sorted(terms)
+        self._books = frozenset()
+
+    def estimate_costs(self, indexer, sizes: Dict[str, int]) -> None:
+        if self.terms:
+            self._books = indexer._search_fields_cached({self.field: set(self.terms)})
+        self.estimate = len(self._books)
+
+    def run(self, indexer, within):
+        return self._done('fields', self._books if within is None else self._books & within)
+
+    def describe(self) -> str:
+        return f'FIELD {self.field}:{" ".join(self.terms) or "nothing"}'
+
+
+class AllPlan(PlanNode):
+    '''every indexed book, what a query of only NOT clauses is subtracted from'''
+
+    def run(self, indexer, within):
+        if within is not None:
+            return self._done('within', within)
+        return self._done('indexed books', frozenset(indexer.get_indexed_books()))
+
+    def describe(self) -> str:
+        return 'ALL'
+
+
+class AndPlan(PlanNode):
+    '''positives intersected cheapest first, then negatives subtracted from what is left
+
+    each operand only matches among the books that survived the ones
+    before it, and nothing more runs once that is empty
+    '''
+
+    def __init__(self, positives: List[PlanNode], negatives: List[PlanNode]):
+        super().__init__()
+        self.positives = positives
+        self.negatives = negatives
+
+    def children(self) -> List[PlanNode]:
+        return self.positives + self.negatives
+
+    def estimate_costs(self, indexer, sizes: Dict[str, int]) -> None:
+        super().estimate_costs(indexer, sizes)
+        self.positives.sort(key=_sort_key)
+        # large negatives first, they empty the result soonest
+        self.negatives.sort(key=_sort_key, reverse=True)
+        estimates = [node.estimate for node in self.positives if node.estimate is not None]
+        self.estimate = min(estimates) if estimates else None
+
+    def run(self, indexer, within):
+        books = within
+        operands = [(node, False) for node in self.positives] + [(node, True) for node in self.negatives]
+        for i, (node, negated) in enumerate(operands):
+            if books is not None and not books:
+                for rest, _ in operands[i:]:
+                    rest.skip()
+                break
+            books = books - node.run(indexer, books) if negated else node.run(indexer, books)
+        return self._done('intersect', books)
+
+    def describe(self) -> str:
+        return 'AND'
+
+
+class OrPlan(PlanNode):
+    '''union of the alternatives, largest first, stopping once every candidate matched'''
+
+    def __init__(self, alternatives: List[PlanNode]):
+        super().__init__()
+        self.alternatives = alternatives
+
+    def children(self) -> List[PlanNode]:
+        return self.alternatives
+
+    def estimate_costs(self, indexer, sizes: Dict[str, int]) -> None:
+        super().estimate_costs(indexer, sizes)
+        self.alternatives.sort(key=_sort_key, reverse=True)
+        estimates = [node.estimate for node in self.alternatives]
+        self.estimate = None if None in estimates else sum(estimates)
+
+    def run(self, indexer, within):
+        books = frozenset()
+        for i, node in enumerate(self.alternatives):
+            if within is not None and len(books) == len(within):
+                for rest in self.alternatives[i:]:
+                    rest.skip()
+                break
+            books |= node.run(indexer, within)
+        return self._done('union', books)
+
+    def describe(self) -> str:
+        return 'OR'
+
+
+def format_plan(node: PlanNode, analyze: bool = False, depth: int = 0, prefix: str = '') -> str:
+    '''one line per operator in the order they run, with rows and methods after a run'''
+    estimate = 'all' if node.estimate is None else node.estimate
+    line = f'{"  " * depth}{prefix}{node.describe()}  (est={estimate}'
+    if analyze:
+        line += f', {node.method or "not run"}' + (f', rows={node.rows}' if node.method != 'skipped' else '')
+    lines = [line + ')']
+    negatives = node.negatives if isinstance(node, AndPlan) else []
+    for child in node.children():
+        negated = any(child is negative for negative in negatives)
+        lines.append(format_plan(child, analyze, depth + 1, 'NOT ' if negated else ''))
+    return '\n'.join(lines)
@@ -0,0 +1,165 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from application.analysis import Analyzer
+from application.indexer import Indexer, FIELD_PATTERN, QUERY_TOKEN_PATTERN
+from application.lexicon import is_expandable
+from application.query import BOOLEAN_PATTERN
+from application.storage_backends import StorageBackend
+
+
+class QueryService:
+    '''asyncio front end for Indexer queries
+
+    backend calls run on a pool of Indexers, each owning its own backend
+    connection; identical queries in flight at the same time share one
+    evaluation, and per-term posting lookups issued by concurrent queries
+    within batch_window seconds are sent to the backend as one
+    search_word_batch call
+
+        async with QueryService(RedisBackend, pool_size=8) as service:
+            book_ids = await service.search('frankenstein monster')
+    '''
+
+    def __init__(self, backend_factory: Callable[[], StorageBackend], pool_size: int = 4,
+                 batch_window: float = 0.002, max_batch_terms: int = 256, analyzer: Optional[Analyzer] = None,
+                 positional: bool = False):
+        self.backend_factory = backend_factory
+        self.analyzer = analyzer
+        self.positional = positional
+        self.pool_size = pool_size
+        self.batch_window = batch_window
+        self.max_batch_terms = max_batch_terms
+        self.stats = {'queries': 0, 'coalesced': 0, 'term_batches': 0, 'batched_terms': 0}
+        self._executor = None
+        self._indexers = None
+        self._tokenizer = None
+        self._inflight = {}
+        self._pending_terms = {}
+        self._flush_handle = None
+        self._tasks = set()
+
+    async def start(self):
+        '''open pool_size backend connections'''
+        loop = asyncio.get_running_loop()
+        self._executor = ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix='query')
+        indexers = await asyncio.gather(*[
+            loop.run_in_executor(self._executor, lambda: Indexer(self.backend_factory(), analyzer=self.analyzer,
+                                                                 positional=self.positional))
+            for _ in range(self.pool_size)
+        ])
+        self._indexers = asyncio.Queue()
+        for indexer in indexers:
+            self._indexers.put_nowait(indexer)
+        self._tokenizer = indexers[0]
+
+    async def close(self):
+        if self._pending_terms:
+            self._flush_terms()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._executor.shutdown(wait=True)
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def _run(self, fn: Callable, *args):
+        '''run fn(indexer, *args) in the thread pool on a borrowed indexer'''
+        indexer = await self._indexers.get()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, fn, indexer, *args)
+        finally:
+            self._indexers.put_nowait(indexer)
+
+    async def _coalesce(self, key: Tuple, make_coro: Callable):
+        self.stats['queries'] += 1
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(make_coro())
+            self._inflight[key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            self.stats['coalesced'] += 1
+        # shielded so one cancelled caller does not cancel the shared evaluation
+        return await asyncio.shield(future)
+
+    def _lookup_term(self, word: str) -> asyncio.Future:
+        future = self._pending_terms.get(word)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self._pending_terms[word] = future
+            if len(self._pending_terms) >= self.max_batch_terms:
+                self._flush_terms()
+            elif self._flush_handle is None:
+                self._flush_handle = asyncio.get_running_loop().call_later(self.batch_window, self._flush_terms)
+        return future
+
+    def _flush_terms(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending_terms = self._pending_terms, {}
+        task = asyncio.ensure_future(self._fetch_terms(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _fetch_terms(self, batch: Dict[str, asyncio.Future]):
+        self.stats['term_batches'] += 1
+        self.stats['batched_terms'] += len(batch)
+        try:
+            postings = await self._run(lambda indexer, words: indexer.backend.search_word_batch(words), list(batch))
+        except Exception as e:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for word, future in batch.items():
+            if not future.done():
+                future.set_result(postings.get(word, set()))
+
+    async def _search(self, words: List[str]) -> List[str]:
+        book_sets: List[Set[str]] = await asyncio.gather(*[self._lookup_term(word) for word in words])
+        result_books = None
+        for book_set in sorted(book_sets, key=len):
+            result_books = set(book_set) if result_books is None else result_books & book_set
+            if not result_books:
+                break
+        return list(result_books)
+
+    async def search(self, query: str) -> List[str]:
+        '''books matching query, same results as Indexer.search_books with this analyzer and positional
+
+        plain words are answered from batched term lookups, every other
+        query syntax is handed to Indexer.search_books
+        '''
+        if BOOLEAN_PATTERN.search(query) or FIELD_PATTERN.search(query) or (self.positional and '"' in query) or \
+                any(is_expandable(token) for token in QUERY_TOKEN_PATTERN.findall(query.lower())):
+            # boolean operators, field filters, phrases and wildcard / fuzzy terms are planned on one indexer
+            # operators are upper case, so boolean queries only coalesce with the same spelling
+            key = ('search', query if BOOLEAN_PATTERN.search(query) else query.lower())
+            return list(await self._coalesce(key, lambda: self._run(Indexer.search_books, query)))
+
+        words = sorted(self._tokenizer.tokenize_text(query))
+        if not words:
+            return []
+        return list(await self._coalesce(('search', tuple(words)), lambda: self._search(words)))
+
+    async def search_ranked(self, query: str, k: int = 10) -> List[Tuple[str, float]]:
+        key = ('ranked', tuple(sorted(self._tokenizer.tokenize_text(query))), k)
+        return list(await self._coalesce(key, lambda: self._run(Indexer.search_ranked, query, k)))
+
+    async def get_book_info(self, book_id: str) -> Dict:
+        return dict(await self._coalesce(('book', book_id), lambda: self._run(Indexer.get_book_info, book_id)))
+
+    async def get_books_info(self, book_ids: List[str]) -> Dict[str, Dict]:
+        '''metadata of a result page in one backend round-trip'''
+        book_ids = tuple(book_ids)
+        return dict(await self._coalesce(('books', book_ids), lambda: self._run(Indexer.get_books_info, book_ids)))
+
+    def get_stats(self) -> Dict:
+        return dict(self.stats)
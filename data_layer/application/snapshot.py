@@ -0,0 +1,233 @@
+import contextlib
+import json
+import os
+import struct
+import sys
+import zlib
+from typing import BinaryIO, Dict, Iterator, Tuple
+
+from application.indexer import book_fields
+from application.postings import decode_postings, encode_postings
+from application.storage_backends import POSTINGS_CHUNK_SIZE, StorageBackend
+
+# snapshot layout (little endian), written and read as one forward stream:
+#   header   magic(8) version(u16)
+#   records  kind(u8) payload_len(u32) payload
+#     B  book_id_len(u16) book_id metadata(JSON)        one per book, ordinal = order of appearance
+#     T  word_len(u16) word df(u32) postings            one per word, after every B record;
+#                                                       postings as in segments, keyed by book ordinal
+#     E  books(u64) terms(u64) crc32(u32)               last record, crc32 of every byte before it
+SNAPSHOT_MAGIC = b'BDSNAP\r\n'
+SNAPSHOT_VERSION = 1
+_HEADER = struct.Struct('<8sH')
+_RECORD = struct.Struct('<cI')
+_NAME_LEN = struct.Struct('<H')
+_DF = struct.Struct('<I')
+_END = struct.Struct('<QQI')
+
+BOOK, TERM, END = b'B', b'T', b'E'
+
+# metadata fields carried by a snapshot, whatever else a backend stores
+METADATA_FIELDS = ('title', 'author', 'language', 'word_count', 'unique_words')
+
+
+class SnapshotError(ValueError):
+    pass
+
+
+class _ChecksumWriter:
+    def __init__(self, out: BinaryIO):
+        self.out = out
+        self.crc = 0
+
+    def write(self, data: bytes) -> None:
+        self.crc = zlib.crc32(data, self.crc)
+        self.out.write(data)
+
+
+def _metadata_record(metadata: Dict) -> Dict:
+    record = {field: metadata.get(field, '') for field in METADATA_FIELDS}
+    record['word_count'] = int(record['word_count'] or 0)
+    record['unique_words'] = int(record['unique_words'] or 0)
+    return record
+
+
+def export_snapshot(backend: StorageBackend, out: BinaryIO) -> Dict[str, int]:
+    '''write the whole index of backend to a binary stream, returns record counts
+
+    postings are read through iter_postings and written one word at a time,
+    so neither side holds more than a word's postings in memory besides the
+    book ordinals; positional data and postings of books without metadata
+    are not part of a snapshot; raises SnapshotError when books come
+    without any postings
+    '''
+    writer = _ChecksumWriter(out)
+    writer.write(_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION))
+
+    ordinals = {}
+    book_ids = sorted(backend.get_indexed_books())
+    for start in range(0, len(book_ids), POSTINGS_CHUNK_SIZE):
+        chunk = book_ids[start:start + POSTINGS_CHUNK_SIZE]
+        found = backend.get_books_metadata(chunk)
+        for book_id in chunk:
+            if book_id not in found:
+                continue
+            metadata = _metadata_record(found[book_id])
+            raw = book_id.encode('utf-8')
+            payload = _NAME_LEN.pack(len(raw)) + raw + json.dumps(metadata, separators=(',', ':')).encode('utf-8')
+            writer.write(_RECORD.pack(BOOK, len(payload)) + payload)
+            ordinals[book_id] = len(ordinals)
+
+    terms = 0
+    for word, book_tfs in backend.iter_postings():
+        postings = {ordinals[book_id]: tf for book_id, tf in book_tfs.items() if book_id in ordinals}
+        if not postings:
+            continue
+        raw = word.encode('utf-8')
+        payload = _NAME_LEN.pack(len(raw)) + raw + _DF.pack(len(postings)) + encode_postings(postings)
+        writer.write(_RECORD.pack(TERM, len(payload)) + payload)
+        terms += 1
+
+    if ordinals and not terms:
+        # restoring such a snapshot would wipe the index, leave it without a trailer so it never loads
+        raise SnapshotError(f'{len(ordinals)} indexed books but no postings to export, '
+                            f'the backend postings are missing or unreadable')
+
+    end = _END.pack(len(ordinals), terms, writer.crc)
+    out.write(_RECORD.pack(END, len(end)) + end)
+    return {'books': len(ordinals), 'terms': terms}
+
+
+class SnapshotReader:
+    '''forward-only reader of a snapshot stream
+
+    books() has to be exhausted before postings(), matching the order of
+    the records; the trailer checksum is verified once postings() is done
+    '''
+
+    def __init__(self, stream: BinaryIO):
+        self.stream = stream
+        self.crc = 0
+        self.book_ids = []
+        self._pending = None
+        magic, version = _HEADER.unpack(self._read(_HEADER.size))
+        if magic != SNAPSHOT_MAGIC:
+            raise SnapshotError('not an index snapshot')
+        if version != SNAPSHOT_VERSION:
+            raise SnapshotError(f'unsupported snapshot version {version}')
+
+    def _read(self, size: int, checksum: bool = True) -> bytes:
+        data = self.stream.read(size)
+        if len(data) != size:
+            raise SnapshotError('snapshot is truncated')
+        if checksum:
+            self.crc = zlib.crc32(data, self.crc)
+        return data
+
+    def _next_record(self) -> Tuple[bytes, bytes]:
+        if self._pending is not None:
+            record, self._pending = self._pending, None
+            return record
+        header = self.stream.read(_RECORD.size)
+        if len(header) != _RECORD.size:
+            raise SnapshotError('snapshot is truncated')
+        kind, length = _RECORD.unpack(header)
+        if kind == END:
+            return kind, self._read(length, checksum=False)
+        self.crc = zlib.crc32(header, self.crc)
+        return kind, self._read(length)
+
+    @staticmethod
+    def _name(payload: bytes) -> Tuple[str, int]:
+        length, = _NAME_LEN.unpack_from(payload)
+        end = _NAME_LEN.size + length
+        return payload[_NAME_LEN.size:end].decode('utf-8'), end
+
+    def books(self) -> Iterator[Tuple[str, Dict]]:
+        while True:
+            kind, payload = self._next_record()
+            if kind != BOOK:
+                self._pending = kind, payload
+                return
+            book_id, end = self._name(payload)
+            self.book_ids.append(book_id)
+            yield book_id, json.loads(payload[end:])
+
+    def postings(self) -> Iterator[Tuple[str, Dict[str, int]]]:
+        terms = 0
+        while True:
+            kind, payload = self._next_record()
+            if kind == END:
+                break
+            if kind != TERM:
+                raise SnapshotError(f'unexpected {kind!r} record among the postings')
+            word, end = self._name(payload)
+            postings = decode_postings(payload[end + _DF.size:])
+            terms += 1
+            yield word, {self.book_ids[ordinal]: tf for ordinal, tf in postings.items()}
+
+        books, end_terms, crc = _END.unpack(payload)
+        if (books, end_terms) != (len(self.book_ids), terms):
+            raise SnapshotError('snapshot record counts do not match its trailer')
+        if crc != self.crc:
+            raise SnapshotError('snapshot checksum mismatch')
+
+
+def import_snapshot(backend: StorageBackend, stream: BinaryIO) -> Dict[str, int]:
+    '''load a snapshot into backend through its bulk_load path, returns record counts
+
+    book records are read first, and books the backend already holds are
+    deleted so words the snapshot lacks keep no postings; term records are
+    streamed into the backend as they are read; a corrupt or truncated
+    stream raises SnapshotError, after the backend has loaded what came
+    before unless its bulk path is one transaction
+    '''
+    reader = SnapshotReader(stream)
+    terms = 0
+    books = list(reader.books())
+    fields = {book_id: book_fields(metadata) for book_id, metadata in books}
+
+    for start in range(0, len(books), POSTINGS_CHUNK_SIZE):
+        chunk = [book_id for book_id, _ in books[start:start + POSTINGS_CHUNK_SIZE]]
+        for book_id in backend.get_books_metadata(chunk):
+            backend.delete_book(book_id)
+
+    def counted_postings():
+        nonlocal terms
+        for word, book_tfs in reader.postings():
+            terms += 1
+            yield word, book_tfs
+
+    backend.bulk_load(books, counted_postings())
+    # field terms are not stored in the snapshot, they are derived again from the metadata
+    for book_id, terms_by_field in fields.items():
+        backend.store_book_fields(book_id, terms_by_field)
+    return {'books': len(reader.book_ids), 'terms': terms}
+
+
+if __name__ == '__main__':
+    from application.pipeline import create_backend
+
+    if len(sys.argv) != 4 or sys.argv[1] not in ('export', 'import'):
+        print('usage: python -m application.snapshot export|import BACKEND PATH (- for stdout / stdin)')
+        sys.exit(2)
+
+    command, backend_name, path = sys.argv[1:]
+    # stdout may be the snapshot itself
+    with contextlib.redirect_stdout(sys.stderr):
+        backend = create_backend(backend_name)
+    if command == 'export':
+        stream = sys.stdout.buffer if path == '-' else open(path, 'wb')
+        try:
+            with stream:
+                counts = export_snapshot(backend, stream)
+        except SnapshotError:
+            if path != '-':
+                os.remove(path)
+            raise
+    else:
+        stream = sys.stdin.buffer if path == '-' else open(path, 'rb')
+        with stream:
+            counts = import_snapshot(backend, stream)
+        backend.flush()
+    print(f'{command}ed {counts["books"]} books, {counts["terms"]} words', file=sys.stderr)
@@ -7,11 +7,45 @@ Run: pytest tests/ -v
 import pytest
 import sys
 import os
+import io
+import json
+import uuid
+import asyncio
 sys.path.append('/app')
 sys.path.append('/app/application')
 
-from storage_backends import RedisBackend, PostgreSQLBackend
+from storage_backends import (RedisBackend, BitmapRedisBackend, PostgreSQLBackend, CompactPostgreSQLBackend,
+                              EmbeddedBackend, ShardedBackend, HashRing)
 from indexer import Indexer
+from cache import LRUCache
+from service import QueryService
+from instrumentation import Metrics, instrument_backend, profile_book
+from lexicon import Lexicon
+from analysis import PorterStemmer, get_analyzer
+from datalake import LooseDatalake, PackedDatalake, open_datalake
+from snapshot import SnapshotError, export_snapshot, import_snapshot
+from postings import decode_positions, encode_positions, read_positions_file, write_positions_file
+from application.downloader import HeaderBodySplitter, download_books_async
+from application.pipeline import stream_books
+
+
+ALL_BACKENDS = [RedisBackend, BitmapRedisBackend, PostgreSQLBackend, CompactPostgreSQLBackend, EmbeddedBackend,
+                ShardedBackend]
+
+
+def make_backend(backend_class, tmp_path):
+    """Server backends use the compose services, the embedded one a temp directory"""
+    if backend_class is EmbeddedBackend:
+        return EmbeddedBackend(tmp_path / 'index')
+    if backend_class is ShardedBackend:
+        # two Redis databases stand in for two Redis servers; the compose database
+        # is left to PostgreSQLBackend, whose rows would otherwise show through
+        return ShardedBackend({
+            'redis-a': RedisBackend(db=13),
+            'redis-b': RedisBackend(db=14),
+            'embedded': EmbeddedBackend(tmp_path / 'shard'),
+        })
+    return backend_class()
 
 
 @pytest.fixture
@@ -27,10 +61,24 @@ def sample_book_data():
     }
 
 
-@pytest.mark.parametrize("backend_class", [RedisBackend, PostgreSQLBackend])
-def test_backend_connection(backend_class):
+@pytest.fixture
+def small_datalake(tmp_path):
+    """Tiny datalake with two complete books and one missing its body"""
+    books = {
+        'test_pool_001': ('Title: Pool Book One\nAuthor: First Author\n', 'parallel tokenizer alpha'),
+        'test_pool_002': ('Title: Pool Book Two\nAuthor: Second Author\n', 'parallel tokenizer beta'),
+    }
+    for book_id, (header, body) in books.items():
+        (tmp_path / f'header_{book_id}.txt').write_text(header, encoding='utf-8')
+        (tmp_path / f'body_{book_id}.txt').write_text(body, encoding='utf-8')
+    (tmp_path / 'header_test_pool_broken.txt').write_text('Title: Broken\n', encoding='utf-8')
+    return tmp_path
+
+
+@pytest.mark.parametrize("backend_class", ALL_BACKENDS)
+def test_backend_connection(backend_class, tmp_path):
     """Test backend connections work"""
-    backend = backend_class()
+    backend = make_backend(backend_class, tmp_path)
     assert backend.test_connection(), f"{backend_class.__name__} connection failed"
 
 
@@ -69,21 +117,1075 @@ def test_word_index_functionality():
     assert 'book_002' not in java_books
 
 
-def test_cross_backend_consistency(sample_book_data):
-    """Test both backends produce same results"""
+@pytest.mark.parametrize("backend_class", ALL_BACKENDS)
+def test_bulk_postings_ingest(backend_class, tmp_path):
+    """Test bulk add_book_postings indexes every word for the book"""
+    backend = make_backend(backend_class, tmp_path)
+    words = {f'bulkword_{i}' for i in range(2500)}
+
+    backend.add_book_postings('bulk_book_001', words)
+
+    assert 'bulk_book_001' in backend.search_word('bulkword_0')
+    assert 'bulk_book_001' in backend.search_word('bulkword_2499')
+    assert 'bulk_book_001' not in backend.search_word('bulkword_missing')
+
+
+def test_cross_backend_consistency(sample_book_data, tmp_path):
+    """Test all backends produce same results"""
     redis_backend = RedisBackend()
     postgres_backend = PostgreSQLBackend()
+    embedded_backend = EmbeddedBackend(tmp_path / 'index')
 
     redis_indexer = Indexer(redis_backend)
     postgres_indexer = Indexer(postgres_backend)
+    embedded_indexer = Indexer(embedded_backend)
 
     redis_indexer.index_book(sample_book_data)
     postgres_indexer.index_book(sample_book_data)
+    embedded_indexer.index_book(sample_book_data)
 
     redis_search = redis_indexer.search_books("functional test")
     postgres_search = postgres_indexer.search_books("functional test")
+    embedded_search = embedded_indexer.search_books("functional test")
 
     assert set(redis_search) == set(postgres_search)
+    assert set(embedded_search) == set(redis_search) & {sample_book_data['book_id']}
+
+
+def test_parallel_index_all_books(small_datalake, capsys):
+    """Test process-pool indexing writes every book and reports failures"""
+    indexer = Indexer(RedisBackend())
+    indexer.datalake_path = small_datalake
+
+    indexer.index_all_books(force_reindex=True, workers=2, max_in_flight=2)
+
+    output = capsys.readouterr().out
+    assert set(indexer.search_books("parallel tokenizer")) >= {'test_pool_001', 'test_pool_002'}
+    assert 'Error indexing book test_pool_broken' in output
+    assert 'Indexing complete!' in output
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 4096])
+def test_streaming_tokenizer_matches_full_text(chunk_size):
+    """Test chunked tokenization handles words spanning chunk boundaries"""
+    indexer = Indexer(RedisBackend())
+    text = "\ufeffThe Project Gutenberg eBook\n  of Frankenstein;\tor, the Modern Prometheus.  "
+
+    term_freqs, word_count = indexer.tokenize_stream(io.StringIO(text), chunk_size=chunk_size)
+
+    assert set(term_freqs) == indexer.tokenize_text(text)
+    assert term_freqs['the'] == 2
+    assert word_count == len(text.split())
+
+
+@pytest.mark.parametrize("backend_class", ALL_BACKENDS)
+def test_ranked_search_orders_by_bm25(backend_class, tmp_path):
+    """Test ranked search puts the book with higher term frequency first"""
+    indexer = Indexer(make_backend(backend_class, tmp_path))
+    for book_id, whale_tf in [('test_rank_001', 1), ('test_rank_002', 12), ('test_rank_003', 4)]:
+        indexer.index_book({
+            'book_id': book_id,
+            'title': f'Ranking {book_id}',
+            'all_words': {'rankwhale', 'rankship'},
+            'term_freqs': {'rankwhale': whale_tf, 'rankship': 2},
+            'word_count': 500
+        })
+    indexer.index_book({
+        'book_id': 'test_rank_004',
+        'title': 'Ranking without ships',
+        'all_words': {'rankwhale'},
+        'term_freqs': {'rankwhale': 50},
+        'word_count': 500
+    })
+
+    ranked = indexer.search_ranked("rankwhale rankship", k=2)
+
+    assert [book_id for book_id, _ in ranked] == ['test_rank_002', 'test_rank_003']
+    assert ranked[0][1] > ranked[1][1]
+
+
+def test_embedded_backend_segments_persist(tmp_path):
+    """Test embedded postings survive flush, segment merges and reopening"""
+    backend = EmbeddedBackend(tmp_path / 'index', flush_threshold=3, max_segments=2)
+    for i in range(6):
+        backend.store_book_metadata(f'seg_book_{i}', {'title': f'Segment {i}', 'word_count': 10})
+        backend.add_book_postings(f'seg_book_{i}', ['segment', f'only{i}'], {'segment': i + 1})
+    backend.flush()
+
+    reopened = EmbeddedBackend(tmp_path / 'index')
+
+    assert reopened.search_word('segment') == {f'seg_book_{i}' for i in range(6)}
+    assert reopened.search_word('only3') == {'seg_book_3'}
+    assert reopened.get_book_metadata('seg_book_2')['title'] == 'Segment 2'
+    assert reopened.get_stats()['unique_words'] == 7
+    assert len(list((tmp_path / 'index').glob('seg_*.seg'))) <= 2
+
+
+@pytest.mark.parametrize("backend_class", ALL_BACKENDS)
+def test_search_cache_invalidated_by_writes(backend_class, tmp_path):
+    """Test repeated queries hit the cache until an index write bumps the generation"""
+    indexer = Indexer(make_backend(backend_class, tmp_path))
+    run = ''.join(c for c in uuid.uuid4().hex if c.isalpha())
+    words = {f'cachequery{run}', f'cachehit{run}'}
+    query = ' '.join(words)
+    indexer.index_book({'book_id': 'test_cache_001', 'title': 'Cache One',
+                        'all_words': words, 'word_count': 10})
+
+    first = indexer.search_books(query)
+    second = indexer.search_books(' '.join(reversed(query.split())))
+    assert set(first) == set(second) == {'test_cache_001'}
+    assert indexer.get_stats()['cache']['hits'] >= 1
+
+    indexer.index_book({'book_id': 'test_cache_002', 'title': 'Cache Two',
+                        'all_words': words, 'word_count': 10})
+
+    assert set(indexer.search_books(query)) == {'test_cache_001', 'test_cache_002'}
+    assert indexer.get_stats()['cache']['invalidations'] >= 1
+
+
+def test_lru_cache_eviction_and_ttl():
+    """Test the query cache evicts least recently used entries and expires old ones"""
+    cache = LRUCache(max_size=2, ttl=60)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    cache.get('a')
+    cache.put('c', 3)
+
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.stats()['evictions'] == 1
+
+    expired = LRUCache(max_size=2, ttl=-1)
+    expired.put('a', 1)
+    assert expired.get('a') is None
+
+
+@pytest.mark.parametrize("backend_class", ALL_BACKENDS)
+def test_server_side_intersection(backend_class, tmp_path):
+    """Test backends intersect postings themselves, rarest word first"""
+    backend = make_backend(backend_class, tmp_path)
+    for i in range(20):
+        words = ['intercommon'] + (['interrare'] if i % 5 == 0 else []) + (['intermid'] if i % 2 == 0 else [])
+        backend.add_book_postings(f'test_inter_{i:03d}', words)
+
+    sizes = backend.posting_sizes(['interrare', 'intercommon', 'intermissing'])
+    assert sizes['interrare'] < sizes['intercommon']
+    assert sizes['intermissing'] == 0
+
+    expected = {'test_inter_000', 'test_inter_010'}
+    assert backend.search_words(['intercommon', 'intermid', 'interrare']) == expected
+    assert backend.search_words(['intercommon', 'intermissing']) == set()
+
+
+def test_hash_ring_moves_only_keys_taken_over():
+    """Test adding a node to the ring moves about 1/n of the keys, all of them to the new node"""
+    keys = [f'word{i}' for i in range(5000)]
+    ring = HashRing(['shard-a', 'shard-b', 'shard-c'])
+    before = {key: ring.node(key) for key in keys}
+    assert set(before.values()) == {'shard-a', 'shard-b', 'shard-c'}
+
+    ring.add_node('shard-d')
+    moved = [key for key in keys if ring.node(key) != before[key]]
+    assert all(ring.node(key) == 'shard-d' for key in moved)
+    assert 0.1 < len(moved) / len(keys) < 0.4
+
+
+def test_sharded_backend_partitions_words_and_books(tmp_path):
+    """Test postings land on the word's shard, metadata on the book's, and lookups merge across shards"""
+    run = ''.join(c for c in uuid.uuid4().hex if c.isalpha())
+    backend = ShardedBackend({name: EmbeddedBackend(tmp_path / name) for name in ('one', 'two', 'three')})
+    words = [f'shard{run}{i}' for i in range(30)]
+    for i in range(10):
+        book_id = f'shard_{run}_{i}'
+        backend.store_book_metadata(book_id, {'title': f'Shard {i}', 'word_count': 100})
+        backend.add_book_postings(book_id, words[:i + 21])
+
+    for name, shard in backend.shards.items():
+        assert all(backend._ring.node(word) == name for word, _ in shard.iter_vocabulary())
+        assert all(backend._ring.node(f'book:{book_id}') == name for book_id in shard.get_indexed_books())
+    assert sum(1 for shard in backend.shards.values() if shard.get_stats()['unique_words']) > 1
+
+    assert backend.get_stats()['total_books'] == 10
+    assert backend.get_stats()['unique_words'] == 30
+    assert backend.search_words([words[0], words[25]]) == {f'shard_{run}_{i}' for i in range(5, 10)}
+    assert backend.posting_sizes([words[29], 'missing']) == {words[29]: 1, 'missing': 0}
+    assert backend.get_book_metadata(f'shard_{run}_3')['title'] == 'Shard 3'
+
+
+def test_incremental_indexing_with_manifest(small_datalake, tmp_path, capsys):
+    """Test reruns skip unchanged books and reindex only changed contents"""
+    indexer = Indexer(EmbeddedBackend(tmp_path / 'index'))
+    indexer.datalake_path = small_datalake
+    indexer.index_all_books()
+    capsys.readouterr()
+
+    body = small_datalake / 'body_test_pool_001.txt'
+    os.utime(body)
+    indexer.index_all_books()
+    output = capsys.readouterr().out
+    assert 'Skipping 2 already indexed' in output
+    assert 'Reindexing' not in output
+
+    body.write_text('parallel tokenizer alpha gamma', encoding='utf-8')
+    indexer.index_all_books()
+    output = capsys.readouterr().out
+    assert 'Reindexing 1 changed books' in output
+    assert 'Indexed book 2/2: test_pool_001' in output or 'Indexed book 1/2: test_pool_001' in output
+    assert indexer.search_books("gamma") == ['test_pool_001']
+
+
+@pytest.mark.parametrize("backend_class", ALL_BACKENDS)
+def test_stats_maintained_incrementally(backend_class, tmp_path):
+    """Test stats counters track new books and words without double counting re-indexing"""
+    indexer = Indexer(make_backend(backend_class, tmp_path))
+    run = ''.join(c for c in uuid.uuid4().hex if c.isalpha())
+    book = {'book_id': f'test_stats_{run}', 'title': 'Stats',
+            'all_words': {f'statsone{run}', f'statstwo{run}'}, 'word_count': 10}
+    before = indexer.get_stats()
+
+    indexer.index_book(book)
+    indexer.index_book(book)
+    after = indexer.get_stats()
+
+    assert after['total_books'] - before['total_books'] == 1
+    assert after['unique_words'] - before['unique_words'] == 2
+    assert after['indexed_books'] == after['total_books']
+
+
+def test_compact_schema_migration():
+    """Test word_index postings migrate into the compact array schema"""
+    classic = PostgreSQLBackend()
+    run = ''.join(c for c in uuid.uuid4().hex if c.isalpha())
+    classic.add_book_postings(f'test_migrate_{run}', [f'migrateone{run}', f'migratetwo{run}'],
+                              {f'migrateone{run}': 3})
+
+    compact = CompactPostgreSQLBackend()
+    assert compact.migrate_from_word_index() >= 1
+
+    assert compact.search_word(f'migrateone{run}') == {f'test_migrate_{run}'}
+    assert compact.search_words([f'migrateone{run}', f'migratetwo{run}']) == {f'test_migrate_{run}'}
+
+
+def test_postgres_backends_share_the_lexicon():
+    """Test deleting through one Postgres schema keeps words the other one still uses"""
+    classic = PostgreSQLBackend()
+    compact = CompactPostgreSQLBackend()
+    run = ''.join(c for c in uuid.uuid4().hex if c.isalpha())
+    word = f'sharedword{run}'
+    compact.add_book_postings(f'test_shared_compact_{run}', [word])
+    classic.add_book_postings(f'test_shared_classic_{run}', [word])
+    before = classic.get_stats()
+
+    classic.delete_book(f'test_shared_classic_{run}')
+    assert compact.search_word(word) == {f'test_shared_compact_{run}'}
+    assert compact.get_book_words(f'test_shared_compact_{run}') == {word: 1}
+    assert classic.get_stats()['unique_words'] == before['unique_words']
+
+    classic.add_book_postings(f'test_shared_classic_{run}', [word])
+    compact.delete_book(f'test_shared_compact_{run}')
+    assert classic.search_word(word) == {f'test_shared_classic_{run}'}
+    assert compact.get_stats()['unique_words'] == before['unique_words']
+
+    classic.delete_book(f'test_shared_classic_{run}')
+    assert compact.get_stats()['unique_words'] == before['unique_words'] - 1
+
+
+def test_postgres_delete_book_clears_both_schemas():
+    """Test a book indexed through both Postgres schemas is deleted from both with its shared row"""
+    classic = PostgreSQLBackend()
+    compact = CompactPostgreSQLBackend()
+    run = ''.join(c for c in uuid.uuid4().hex if c.isalpha())
+    book_id = f'test_both_schemas_{run}'
+    before = classic.get_stats()
+    classic.store_book_metadata(book_id, {'title': 'Both', 'word_count': 4})
+    classic.add_book_postings(book_id, [f'classicword{run}'])
+    compact.add_book_postings(book_id, [f'compactword{run}'])
+
+    compact.delete_book(book_id)
+
+    assert classic.search_word(f'classicword{run}') == set()
+    assert compact.search_word(f'compactword{run}') == set()
+    assert not classic.is_book_indexed(book_id)
+    after = classic.get_stats()
+    assert after['total_books'] == before['total_books']
+    assert after['unique_words'] == before['unique_words']
+
+
+class CountingEmbeddedBackend(EmbeddedBackend):
+    """Local stand-in backend that counts batched term lookups"""
+
+    batch_calls = 0
+
+    def search_word_batch(self, words):
+        CountingEmbeddedBackend.batch_calls += 1
+        return super().search_word_batch(words)
+
+
+def test_query_service_coalesces_and_batches(tmp_path):
+    """Test concurrent queries share evaluations and one batched term lookup"""
+    backend = CountingEmbeddedBackend(tmp_path / 'index')
+    indexer = Indexer(backend)
+    indexer.index_book({'book_id': 'svc_001', 'title': 'Service One',
+                        'all_words': {'alpha', 'beta'}, 'word_count': 10})
+    indexer.index_book({'book_id': 'svc_002', 'title': 'Service Two',
+                        'all_words': {'beta', 'gamma'}, 'word_count': 10})
+    CountingEmbeddedBackend.batch_calls = 0
+
+    async def run_queries():
+        async with QueryService(lambda: backend, pool_size=2) as service:
+            results = await asyncio.gather(
+                *[service.search("alpha beta") for _ in range(10)],
+                service.search("beta gamma")
+            )
+            info = await service.get_book_info('svc_002')
+            return results, info, service.get_stats()
+
+    results, info, stats = asyncio.run(run_queries())
+
+    assert all(result == ['svc_001'] for result in results[:10])
+    assert results[10] == ['svc_002']
+    assert info['title'] == 'Service Two'
+    assert stats['coalesced'] == 9
+    assert stats['batched_terms'] == 3
+    assert CountingEmbeddedBackend.batch_calls == 1
+
+
+def test_query_service_honours_query_syntax(tmp_path):
+    """Test phrases, boolean, fielded and wildcard queries get the results Indexer.search_books gives"""
+    books = {'svcq_1': 'the white whale and the sea', 'svcq_2': 'the sea and the white ship'}
+    for book_id, body in books.items():
+        (tmp_path / f'header_{book_id}.txt').write_text(f'Title: {book_id} voyage\n', encoding='utf-8')
+        (tmp_path / f'body_{book_id}.txt').write_text(body, encoding='utf-8')
+    backend = EmbeddedBackend(tmp_path / 'index')
+    indexer = Indexer(backend, positional=True)
+    indexer.datalake_path = tmp_path
+    for book_id in books:
+        indexer.index_book(indexer.process_book(book_id))
+    backend.flush()
+
+    queries = ['"sea and the white"', '"white whale" sea', 'whale OR ship', 'sea NOT whale', 'title:voyage whale', 'wh*']
+
+    async def run_queries():
+        async with QueryService(lambda: backend, pool_size=2, positional=True) as service:
+            return await asyncio.gather(*[service.search(query) for query in queries])
+
+    results = asyncio.run(run_queries())
+    assert [sorted(result) for result in results] == [sorted(indexer.search_books(query)) for query in queries]
+    assert results[0] == ['svcq_2'] and results[1] == ['svcq_1']
+
+
+STREAMED_BOOK = (b"Title: Streamed Book\r\nAuthor: Test Author\r\n\r\n"
+                 b"*** START OF THE PROJECT GUTENBERG EBOOK STREAMED BOOK ***\r\n"
+                 + b"streamed body line\r\n" * 5000 +
+                 b"*** END OF THE PROJECT GUTENBERG EBOOK STREAMED BOOK ***\r\nlicense\r\n")
+STREAMED_HEADER = b"Title: Streamed Book\r\nAuthor: Test Author\r\n\r\n"
+STREAMED_BODY = b"streamed body line\r\n" * 5000
+
+
+class MemorySink:
+    def __init__(self):
+        self.data = b''
+
+    async def write(self, data):
+        self.data += data
+
+
+@pytest.mark.parametrize("chunk_size", [1, 13, 1 << 20])
+def test_header_body_splitter_across_chunks(chunk_size):
+    """Test markers split across chunk boundaries are still found"""
+    header, body = MemorySink(), MemorySink()
+    splitter = HeaderBodySplitter(header, body)
+
+    async def feed():
+        for i in range(0, len(STREAMED_BOOK), chunk_size):
+            await splitter.feed(STREAMED_BOOK[i:i + chunk_size])
+        await splitter.finish()
+
+    asyncio.run(feed())
+    assert header.data == STREAMED_HEADER
+    assert body.data == STREAMED_BODY
+    assert splitter.consumed == len(STREAMED_BOOK)
+
+
+def test_downloader_retries_revalidates_and_resumes(tmp_path):
+    """Test a flaky server is retried, unchanged books get a 304 and partial downloads resume"""
+    from aiohttp import web
+    from aiohttp.test_utils import TestServer
+
+    etag = '"streamed-v1"'
+    seen = []
+    failures = [1]
+
+    async def serve_book(request):
+        seen.append(dict(request.headers))
+        if failures[0]:
+            failures[0] -= 1
+            return web.Response(status=503)
+        if request.headers.get('If-None-Match') == etag:
+            return web.Response(status=304)
+        range_header = request.headers.get('Range')
+        if range_header and request.headers.get('If-Range') == etag:
+            start = int(range_header[len('bytes='):-1])
+            return web.Response(status=206, body=STREAMED_BOOK[start:], headers={
+                'ETag': etag, 'Content-Range': f'bytes {start}-{len(STREAMED_BOOK) - 1}/{len(STREAMED_BOOK)}'})
+        return web.Response(body=STREAMED_BOOK, headers={'ETag': etag})
+
+    async def run_downloads():
+        app = web.Application()
+        app.router.add_get('/{name}', serve_book)
+        server = TestServer(app)
+        await server.start_server()
+        url = str(server.make_url('/streamed_001.txt'))
+        try:
+            first = await download_books_async([url], tmp_path, backoff=0)
+            first_requests = len(seen)
+            second = await download_books_async([url], tmp_path, backoff=0)
+
+            # leave a download interrupted 100 bytes into the body
+            start = STREAMED_BOOK.index(b'streamed body')
+            (tmp_path / 'body_streamed_001.txt').unlink()
+            (tmp_path / 'header_streamed_001.txt.part').write_bytes(STREAMED_HEADER)
+            (tmp_path / 'body_streamed_001.txt.part').write_bytes(STREAMED_BODY[:100])
+            (tmp_path / '.download_streamed_001.json').write_text(
+                json.dumps({'etag': etag, 'offset': start + 100, 'split_state': 'body'}))
+            third = await download_books_async([url], tmp_path, backoff=0)
+        finally:
+            await server.close()
+        return first, first_requests, second, third
+
+    first, first_requests, second, third = asyncio.run(run_downloads())
+
+    assert first == ['streamed_001'] and first_requests == 2
+    assert second == []
+    assert seen[2]['If-None-Match'] == etag
+    assert third == ['streamed_001']
+    assert seen[3]['Range'] == f"bytes={STREAMED_BOOK.index(b'streamed body') + 100}-"
+    assert (tmp_path / 'header_streamed_001.txt').read_bytes() == STREAMED_HEADER
+    assert (tmp_path / 'body_streamed_001.txt').read_bytes() == STREAMED_BODY
+    assert not (tmp_path / 'body_streamed_001.txt.part').exists()
+
+
+def test_streaming_pipeline_indexes_books_as_they_download(tmp_path):
+    """Test books flow through download, tokenize and write stages into the backend"""
+    from aiohttp import web
+    from aiohttp.test_utils import TestServer
+
+    books = {
+        f'stream_{i:03d}': (f"Title: Stream Book {i}\r\n\r\n*** START OF THE PROJECT GUTENBERG EBOOK {i} ***\r\n"
+                            f"pipeline words number{'x' * i}\r\n*** END OF THE PROJECT GUTENBERG EBOOK {i} ***\r\n").encode()
+        for i in range(1, 4)
+    }
+
+    async def serve_book(request):
+        return web.Response(body=books[request.match_info['name'].split('.')[0]])
+
+    backend = EmbeddedBackend(tmp_path / 'index')
+    indexer = Indexer(backend, manifest_path=tmp_path / 'manifest.json')
+    indexer.datalake_path = tmp_path / 'lake'
+
+    async def run_pipeline():
+        app = web.Application()
+        app.router.add_get('/{name}', serve_book)
+        server = TestServer(app)
+        await server.start_server()
+        try:
+            urls = [str(server.make_url(f'/{book_id}.txt')) for book_id in books]
+            return await stream_books(urls, indexer, workers=2, queue_size=1)
+        finally:
+            await server.close()
+
+    stage_stats = asyncio.run(run_pipeline())
+
+    assert [stage_stats[name]['items'] for name in ('download', 'tokenize', 'write')] == [3, 3, 3]
+    assert sorted(indexer.search_books("pipeline words")) == sorted(books)
+    assert indexer.search_books("numberxx") == ['stream_002']
+    assert len(indexer.open_manifest()) == 3
+
+
+def test_packed_datalake_reads_books_lazily_and_keeps_manifests(small_datalake, tmp_path):
+    """Test loose books move into compressed segments with the same fingerprints and index the same"""
+    import pickle
+
+    loose = LooseDatalake(small_datalake)
+    loose_books = loose.scan()
+    digest = loose.digest('test_pool_001')
+
+    packed = open_datalake(small_datalake, 'packed')
+    assert packed.pack_loose(loose) == 2
+    assert not (small_datalake / 'body_test_pool_001.txt').exists()
+    # a pack index marks the format, and pool workers get the process wide instance back
+    assert open_datalake(small_datalake) is packed
+    assert pickle.loads(pickle.dumps(packed)) is packed
+    assert packed.scan() == {book_id: fp for book_id, fp in loose_books.items() if fp is not None}
+    assert packed.digest('test_pool_001') == digest
+    assert packed.read_header('test_pool_002') == 'Title: Pool Book Two\nAuthor: Second Author\n'
+
+    # a long CRLF body is inflated as it is read and stored well below its size
+    body = 'Packed segments stream lines\r\n' * 50000
+    staged_header, staged_body = packed.staging_paths('test_pool_big')
+    staged_header.write_bytes(b'Title: Big Book\r\n')
+    staged_body.write_bytes(body.encode())
+    reader = PackedDatalake(small_datalake)
+    packed.commit_book('test_pool_big', staged_header, staged_body)
+    assert not staged_body.exists()
+    with reader.open_body('test_pool_big') as f:
+        assert f.readline() == 'Packed segments stream lines\n'
+        assert sum(1 for _ in f) == 49999
+    segment_bytes = sum(p.stat().st_size for p in packed.pack_path.glob('seg_*.pack'))
+    assert segment_bytes < len(body) // 50
+
+    backend = EmbeddedBackend(tmp_path / 'index')
+    indexer = Indexer(backend, manifest_path=tmp_path / 'manifest.json')
+    indexer.datalake_path = small_datalake
+    indexer.index_all_books(workers=2)
+    assert sorted(indexer.search_books("tokenizer")) == ['test_pool_001', 'test_pool_002']
+    assert indexer.search_books("segments") == ['test_pool_big']
+    assert indexer.open_manifest().entries['test_pool_001']['sha256'] == digest
+
+
+def test_packed_datalake_rewrites_segments_of_replaced_books(tmp_path):
+    """Test re-committed books leave dead bytes that are reclaimed once they fill half a segment"""
+    packed = PackedDatalake(tmp_path)
+
+    def commit(book_id, version):
+        header, body = packed.staging_paths(book_id)
+        header.write_text(f'Title: {book_id} v{version}\n', encoding='utf-8')
+        body.write_text(f'{book_id} version {version} of the body\n' * 100, encoding='utf-8')
+        packed.commit_book(book_id, header, body)
+
+    commit('rewrite_a', 1)
+    commit('rewrite_b', 1)
+    stale_reader = PackedDatalake(tmp_path)
+    commit('rewrite_a', 2)
+    assert packed.dead_bytes()[0] > 0
+    assert [p.name for p in packed.pack_path.glob('seg_*.pack')] == ['seg_000000.pack']
+
+    commit('rewrite_a', 3)
+    assert [p.name for p in packed.pack_path.glob('seg_*.pack')] == ['seg_000001.pack']
+    assert packed.dead_bytes() == {}
+    for reader in (packed, stale_reader, PackedDatalake(tmp_path)):
+        assert reader.read_header('rewrite_a') == 'Title: rewrite_a v3\n'
+        assert reader.read_header('rewrite_b') == 'Title: rewrite_b v1\n'
+        with reader.open_body('rewrite_b') as f:
+            assert f.readline() == 'rewrite_b version 1 of the body\n'
+    assert PackedDatalake(tmp_path).scan() == packed.scan()
+
+
+@pytest.mark.parametrize("backend_class", ALL_BACKENDS)
+def test_instrumentation_counts_stages_and_round_trips(backend_class, small_datalake, tmp_path):
+    """Test stage timers, per-method round-trips and both export formats"""
+    metrics = Metrics()
+    backend = make_backend(backend_class, tmp_path)
+    # a book indexed by an earlier run would be diffed into no writes at all
+    backend.delete_book('test_pool_001')
+    backend = instrument_backend(backend, metrics)
+    indexer = Indexer(backend, metrics=metrics)
+    indexer.datalake_path = small_datalake
+
+    indexer.index_book(indexer.process_book('test_pool_001'))
+    indexer.search_books("parallel tokenizer")
+
+    for stage in ('read', 'tokenize', 'extract_metadata', 'backend_write', 'search'):
+        assert metrics.histogram('stage_seconds', stage=stage).count == 1
+    name = backend_class.__name__
+    assert metrics.counter('backend_calls_total', backend=name, method='add_book_postings') == 1
+    assert metrics.histogram('backend_call_seconds', backend=name, method='search_words').count == 1
+    if backend_class is not EmbeddedBackend:
+        round_trips = metrics.counter('backend_round_trips_total', backend=name, method='add_book_postings')
+        assert round_trips >= 1
+        assert metrics.counter('backend_commands_total', backend=name, method='add_book_postings') >= round_trips
+
+    prometheus = metrics.to_prometheus()
+    assert '# TYPE datamart_stage_seconds histogram' in prometheus
+    assert 'datamart_stage_seconds_bucket{stage="search",le="+Inf"} 1' in prometheus
+    assert json.loads(metrics.to_json())['histograms']
+
+    assert 'process_book' in profile_book(indexer, 'test_pool_002')
+
+
+@pytest.fixture
+def baseline_redis():
+    """Redis database holding two books the way the baseline RedisBackend indexed them"""
+    import redis
+    client = redis.Redis(host='redis', db=12, decode_responses=True)
+    client.flushdb()
+    books = {'pg84': ('Frankenstein', {'monster', 'creature', 'victor'}),
+             'pg345': ('Dracula', {'monster', 'castle', 'count'})}
+    for book_id, (title, words) in books.items():
+        client.hset(f'book:{book_id}:metadata', mapping={'title': title, 'author': '', 'language': 'English',
+                                                         'word_count': '30', 'unique_words': str(len(words)),
+                                                         'indexed_at': '0'})
+        client.incr('stats:total_books')
+        for word in words:
+            client.sadd(f'word:{word}', book_id)
+            client.sadd('stats:all_words', word)
+    return 12
+
+
+def test_redis_upgrade_ranks_baseline_postings(baseline_redis):
+    """Test word sets of a baseline database get tf sorted sets, so they rank like PostgreSQL rows"""
+    backend = RedisBackend(db=baseline_redis)
+    assert sorted(book_id for book_id, _ in backend.search_ranked(['monster'], 10)) == ['pg345', 'pg84']
+    assert [book_id for book_id, _ in backend.search_ranked(['monster', 'castle'], 10)] == ['pg345']
+    assert backend.get_term_frequencies(['pg84'], ['victor']) == {('pg84', 'victor'): 1}
+
+    # the migration runs once, later counts are not reset to 1 on the next open
+    backend.add_book_postings('pg11', ['monster'], {'monster': 4})
+    assert RedisBackend(db=baseline_redis).search_ranked(['monster'], 1)[0][0] == 'pg11'
+
+
+def test_redis_upgrade_deletes_and_reindexes_baseline_books(baseline_redis):
+    """Test baseline postings reach the forward index, so delete and reindex leave nothing stale"""
+    import redis
+    # an earlier open may already have marked the forward index complete while it was empty
+    redis.Redis(host='redis', db=baseline_redis).set('stats:forward_index', 1)
+    backend = RedisBackend(db=baseline_redis)
+    indexer = Indexer(backend)
+    assert backend.get_book_words('pg84') == {'monster': 1, 'creature': 1, 'victor': 1}
+
+    indexer.index_book({'book_id': 'pg345', 'title': 'Dracula', 'all_words': {'castle', 'count'},
+                        'word_count': 30})
+    assert backend.search_word('monster') == {'pg84'}
+    backend.delete_book('pg84')
+    assert backend.search_word('monster') == set()
+    assert backend.search_word('creature') == set()
+    assert backend.search_word('castle') == {'pg345'}
+
+
+def test_redis_upgrade_loads_baseline_lexicon(baseline_redis):
+    """Test the lexicon of a baseline database serves autocomplete, wildcards and fuzzy terms"""
+    indexer = Indexer(RedisBackend(db=baseline_redis))
+    assert dict(RedisBackend(db=baseline_redis).iter_vocabulary())['monster'] == 2
+    assert indexer.autocomplete('monst') == [('monster', 2)]
+    assert sorted(indexer.search_books('monst*')) == ['pg345', 'pg84']
+    assert indexer.search_books('creatuer~') == ['pg84']
+
+
+def test_bitmap_postings_mix_intsets_and_bitmaps():
+    """Test rare words stay intsets, common ones become bitmaps and queries mix both"""
+    backend = BitmapRedisBackend(db=15)
+    backend.redis_client.flushdb()
+
+    for i in range(64):
+        words = ['common'] + (['even'] if i % 2 == 0 else []) + (['late'] if i >= 62 else [])
+        backend.add_book_postings(f'bitmap_{i:02d}', words)
+
+    assert backend.raw_client.exists('bm:common') and backend.raw_client.exists('bm:even')
+    assert backend.raw_client.exists('ids:late') and not backend.raw_client.exists('bm:late')
+
+    assert backend.posting_sizes(['common', 'even', 'late']) == {'common': 64, 'even': 32, 'late': 2}
+    assert backend.search_words(['common', 'even']) == {f'bitmap_{i:02d}' for i in range(0, 64, 2)}
+    assert backend.search_words(['common', 'even', 'late']) == {'bitmap_62'}
+    assert backend.search_word('late') == {'bitmap_62', 'bitmap_63'}
+    assert backend.search_words(['common', 'missing']) == set()
+
+
+def test_lexicon_prefix_wildcard_and_fuzzy():
+    """Test lexicon expansions come back most frequent first and bounded"""
+    lexicon = Lexicon([('frank', 5), ('frankenstein', 9), ('franklin', 2), ('frail', 4),
+                       ('monster', 7), ('minister', 3), ('mister', 1), ('hamster', 2)])
+
+    assert lexicon.autocomplete('fra', 2) == [('frankenstein', 9), ('frank', 5)]
+    assert lexicon.expand('frank*') == ['frankenstein', 'frank', 'franklin']
+    assert lexicon.expand('frank*', limit=1) == ['frankenstein']
+    assert lexicon.expand('*ster') == ['monster', 'minister', 'hamster', 'mister']
+    assert lexicon.expand('m?ster') == ['mister']
+    assert lexicon.expand('frankenstien~') == ['frankenstein']
+    assert lexicon.expand('monstr~') == ['monster']
+    assert lexicon.expand('unknown') == []
+    assert lexicon.expand('*') == lexicon.expand('?*?') == []
+
+
+@pytest.mark.parametrize("backend_class", ALL_BACKENDS)
+def test_wildcard_and_fuzzy_search(backend_class, tmp_path):
+    """Test search_books expands frank*, fr?nk and typo~ terms through the lexicon"""
+    run = ''.join(c for c in uuid.uuid4().hex if c.isalpha())
+    indexer = Indexer(make_backend(backend_class, tmp_path))
+    indexer.index_book({'book_id': f'lex_{run}_1', 'title': 'Lexicon One',
+                        'all_words': {f'lex{run}frank', f'lex{run}monster'}, 'word_count': 10})
+    indexer.index_book({'book_id': f'lex_{run}_2', 'title': 'Lexicon Two',
+                        'all_words': {f'lex{run}franklin', f'lex{run}monster'}, 'word_count': 10})
+
+    assert sorted(indexer.search_books(f'lex{run}fra*')) == [f'lex_{run}_1', f'lex_{run}_2']
+    assert indexer.search_books(f'lex{run}fra?k lex{run}monster') == [f'lex_{run}_1']
+    assert sorted(indexer.search_books(f'lex{run}monstr~')) == [f'lex_{run}_1', f'lex_{run}_2']
+    assert indexer.search_books(f'lex{run}nothing*') == []
+    assert indexer.autocomplete(f'lex{run}', 1) == [(f'lex{run}monster', 2)]
+    assert indexer.search_books('*') == []
+
+
+def test_lexicon_follows_own_writes_without_rescanning(tmp_path):
+    """Test the indexer's own writes update its lexicon and only a stale one is rescanned"""
+    metrics = Metrics()
+    backend = instrument_backend(EmbeddedBackend(tmp_path / 'index'), metrics)
+    indexer = Indexer(backend, manifest_path=tmp_path / 'manifest.json', metrics=metrics)
+    indexer.index_book({'book_id': 'lexw_1', 'title': 'One', 'all_words': {'monster', 'castle'}, 'word_count': 10})
+    assert indexer.autocomplete('mon') == [('monster', 1)]
+
+    metrics.reset()
+    indexer.index_book({'book_id': 'lexw_2', 'title': 'Two', 'all_words': {'monster', 'monk'}, 'word_count': 10})
+    indexer.index_book({'book_id': 'lexw_1', 'title': 'One', 'all_words': {'castle'}, 'word_count': 10})
+    assert indexer.autocomplete('mon') == [('monk', 1), ('monster', 1)]
+    indexer.delete_book('lexw_2')
+    assert indexer.autocomplete('mon') == []
+    assert indexer.autocomplete('cas') == [('castle', 1)]
+    assert metrics.counter('backend_calls_total', backend='EmbeddedBackend', method='iter_vocabulary') == 0
+
+    indexer.lexicon_ttl = 0
+    assert indexer.autocomplete('cas') == [('castle', 1)]
+    assert metrics.counter('backend_calls_total', backend='EmbeddedBackend', method='iter_vocabulary') == 1
+
+
+def test_search_polls_generation_once_per_interval(tmp_path):
+    """Test cache hits skip the generation round-trip, own writes show at once and others after the interval"""
+    metrics = Metrics()
+    backend = instrument_backend(EmbeddedBackend(tmp_path / 'index'), metrics)
+    indexer = Indexer(backend, metrics=metrics, generation_check_interval=3600)
+    indexer.index_book({'book_id': 'gen_1', 'title': 'One', 'all_words': {'whale'}, 'word_count': 10})
+
+    metrics.reset()
+    for _ in range(5):
+        assert indexer.search_books('whale') == ['gen_1']
+    assert metrics.counter('backend_calls_total', backend='EmbeddedBackend', method='get_generation') == 1
+
+    indexer.index_book({'book_id': 'gen_2', 'title': 'Two', 'all_words': {'whale'}, 'word_count': 10})
+    assert sorted(indexer.search_books('whale')) == ['gen_1', 'gen_2']
+
+    backend.add_book_postings('gen_3', ['whale'])
+    assert sorted(indexer.search_books('whale')) == ['gen_1', 'gen_2']
+    indexer.generation_check_interval = 0
+    assert sorted(indexer.search_books('whale')) == ['gen_1', 'gen_2', 'gen_3']
+    assert metrics.counter('backend_calls_total', backend='EmbeddedBackend', method='get_generation') == 2
+
+
+def test_positions_codec_roundtrip(tmp_path):
+    """Test delta/varint positions survive encoding and the per-book positions file"""
+    positions = [0, 1, 5, 130, 20000, 20001]
+    assert decode_positions(encode_positions(positions)) == positions
+
+    path = tmp_path / 'book.pos'
+    write_positions_file(path, {'whale': encode_positions([3, 9]), 'ship': encode_positions([4])})
+    found = read_positions_file(path, ['ship', 'missing'])
+    assert {word: decode_positions(blob) for word, blob in found.items()} == {'ship': [4]}
+
+
+@pytest.mark.parametrize("backend_class", ALL_BACKENDS)
+def test_phrase_and_proximity_search(backend_class, tmp_path):
+    """Test quoted phrases and search_near on a positional index"""
+    run = ''.join(c for c in uuid.uuid4().hex if c.isalpha())
+    pride, prejudice, sense = f'pride{run}', f'prejudice{run}', f'sense{run}'
+    books = {
+        f'pos_{run}_1': f'It is {pride} and {prejudice}, truly.',
+        f'pos_{run}_2': f'{prejudice} and {pride} are not a phrase here',
+        f'pos_{run}_3': f'{pride} of one, {sense} and then {prejudice} much later on',
+    }
+    for book_id, body in books.items():
+        (tmp_path / f'header_{book_id}.txt').write_text(f'Title: {book_id}\n', encoding='utf-8')
+        (tmp_path / f'body_{book_id}.txt').write_text(body, encoding='utf-8')
+
+    indexer = Indexer(make_backend(backend_class, tmp_path), positional=True)
+    indexer.datalake_path = tmp_path
+    for book_id in books:
+        indexer.index_book(indexer.process_book(book_id))
+    indexer.backend.flush()
+
+    assert sorted(indexer.search_books(f'{pride} {prejudice}')) == sorted(books)
+    assert indexer.search_books(f'"{pride} and {prejudice}"') == [f'pos_{run}_1']
+    assert indexer.search_books(f'"{pride} or {prejudice}"') == [f'pos_{run}_1']
+    assert indexer.search_books(f'"{pride} {prejudice}"') == []
+    assert indexer.search_books(f'"{pride} and {prejudice}" {sense}') == []
+    assert sorted(indexer.search_near(f'{pride} {prejudice}', 2)) == [f'pos_{run}_1', f'pos_{run}_2']
+    assert sorted(indexer.search_near(f'{prejudice} {pride}', 6)) == sorted(books)
+
+    # within restricts the books whose positions are matched, phrase plans pass theirs in
+    assert indexer.search_phrase(f'{pride} and {prejudice}', {f'pos_{run}_2', f'pos_{run}_3'}) == []
+    assert indexer.search_phrase(f'{pride} and {prejudice}', {f'pos_{run}_1'}) == [f'pos_{run}_1']
+    assert indexer.search_phrase(f'{pride} and {prejudice}', set()) == []
+    assert sorted(indexer.search_books(f'"{pride} and {prejudice}" OR {sense}')) == [f'pos_{run}_1', f'pos_{run}_3']
+    assert indexer.search_books(f'{sense} AND "{pride} and {prejudice}"') == []
+
+
+@pytest.mark.parametrize("backend_class", ALL_BACKENDS)
+def test_snapshot_export_and_bulk_restore(backend_class, tmp_path):
+    """Test a snapshot of one backend restores metadata, postings and tfs into another"""
+    run = ''.join(c for c in uuid.uuid4().hex if c.isalpha())
+    source = EmbeddedBackend(tmp_path / 'source')
+    for i in range(5):
+        book_id = f'snap_{run}_{i}'
+        source.store_book_metadata(book_id, {'title': f'Snapshot\t{i}', 'author': 'Back\\slash',
+                                             'language': 'en', 'word_count': 100 + i, 'unique_words': 2})
+        source.add_book_postings(book_id, [f'snap{run}common', f'snap{run}only{i}'],
+                                 {f'snap{run}common': i + 1, f'snap{run}only{i}': 1})
+    snapshot = io.BytesIO()
+    assert export_snapshot(source, snapshot) == {'books': 5, 'terms': 6}
+
+    target = make_backend(backend_class, tmp_path)
+    before = target.get_stats()
+    snapshot.seek(0)
+    assert import_snapshot(target, snapshot) == {'books': 5, 'terms': 6}
+    target.flush()
+
+    after = target.get_stats()
+    assert after['total_books'] - before['total_books'] == 5
+    assert after['unique_words'] - before['unique_words'] == 6
+    assert after['total_word_count'] - before['total_word_count'] == 510
+    metadata = target.get_book_metadata(f'snap_{run}_3')
+    assert metadata['title'] == 'Snapshot\t3' and metadata['author'] == 'Back\\slash'
+    assert int(metadata['word_count']) == 103
+    assert target.search_words([f'snap{run}common', f'snap{run}only2']) == {f'snap_{run}_2'}
+    books = [f'snap_{run}_{i}' for i in range(5)]
+    assert target.get_term_frequencies(books, [f'snap{run}common']) == {
+        (book_id, f'snap{run}common'): i + 1 for i, book_id in enumerate(books)}
+
+    # importing over books the backend holds replaces them, words the snapshot lacks go
+    target.add_book_postings(f'snap_{run}_0', [f'snap{run}stale'])
+    target.flush()
+    snapshot.seek(0)
+    assert import_snapshot(target, snapshot) == {'books': 5, 'terms': 6}
+    target.flush()
+    assert target.search_word(f'snap{run}stale') == set()
+    assert set(target.get_book_words(f'snap_{run}_0')) == {f'snap{run}common', f'snap{run}only0'}
+    assert target.get_stats() == after
+
+
+def test_snapshot_rejects_corrupt_streams(tmp_path):
+    """Test bad magic, truncation and checksum errors are reported"""
+    source = EmbeddedBackend(tmp_path / 'source')
+    source.store_book_metadata('snap_corrupt', {'title': 'Corrupt', 'word_count': 10})
+    source.add_book_postings('snap_corrupt', ['corruptword'])
+    snapshot = io.BytesIO()
+    export_snapshot(source, snapshot)
+    data = snapshot.getvalue()
+
+    with pytest.raises(SnapshotError):
+        import_snapshot(EmbeddedBackend(tmp_path / 'a'), io.BytesIO(b'NOTASNAP' + data[8:]))
+    with pytest.raises(SnapshotError):
+        import_snapshot(EmbeddedBackend(tmp_path / 'b'), io.BytesIO(data[:-5]))
+    flipped = bytearray(data)
+    flipped[data.index(b'Corrupt')] ^= 0x20
+    with pytest.raises(SnapshotError):
+        import_snapshot(EmbeddedBackend(tmp_path / 'c'), io.BytesIO(bytes(flipped)))
+
+
+@pytest.mark.parametrize("backend_class", ALL_BACKENDS)
+def test_instrumentation_counts_snapshot_and_lexicon_paths(backend_class, tmp_path):
+    """Test bulk loads, posting and vocabulary scans and COPY statements are counted like other calls"""
+    run = ''.join(c for c in uuid.uuid4().hex if c.isalpha())
+    source = EmbeddedBackend(tmp_path / 'source')
+    # enough books and words that every shard of a ShardedBackend gets some
+    for i in range(10):
+        source.store_book_metadata(f'instr_{run}_{i}', {'title': 'Instrumented', 'word_count': 10})
+        source.add_book_postings(f'instr_{run}_{i}', [f'instr{run}word', f'instr{run}{"x" * (i + 1)}', f'instr{run}{"y" * (i + 1)}'])
+    snapshot = io.BytesIO()
+    export_snapshot(source, snapshot)
+    snapshot.seek(0)
+
+    metrics = Metrics()
+    name = backend_class.__name__
+    backend = instrument_backend(make_backend(backend_class, tmp_path), metrics)
+    import_snapshot(backend, snapshot)
+    backend.flush()
+    assert Indexer(backend).autocomplete(f'instr{run}w') == [(f'instr{run}word', 10)]
+    export_snapshot(backend, io.BytesIO())
+
+    for method in ('bulk_load', 'iter_vocabulary', 'iter_postings'):
+        assert metrics.counter('backend_calls_total', backend=name, method=method) == 1
+        assert metrics.histogram('backend_call_seconds', backend=name, method=method).sum > 0
+        if backend_class is not EmbeddedBackend:
+            assert metrics.counter('backend_round_trips_total', backend=name, method=method) >= 1
+
+    if backend_class in (PostgreSQLBackend, CompactPostgreSQLBackend):
+        metrics.reset()
+        with backend.conn.cursor() as cur:
+            cur.copy_expert('COPY (SELECT 1) TO STDOUT', io.StringIO())
+        assert metrics.counter('backend_round_trips_total', backend=name, method='other') == 1
+        backend.conn.rollback()
+
+
+def test_snapshot_refuses_books_without_postings(baseline_redis, tmp_path):
+    """Test an export that finds books but no postings fails, while a baseline Redis exports in full"""
+    counts = export_snapshot(RedisBackend(db=baseline_redis), io.BytesIO())
+    assert counts == {'books': 2, 'terms': 5}
+
+    source = EmbeddedBackend(tmp_path / 'source')
+    source.store_book_metadata('snap_bare', {'title': 'No postings', 'word_count': 10})
+    with pytest.raises(SnapshotError):
+        export_snapshot(source, io.BytesIO())
+
+
+@pytest.mark.parametrize("backend_class", ALL_BACKENDS)
+def test_reindex_writes_only_the_diff_and_delete_removes_everything(backend_class, tmp_path):
+    """Test reindexing a changed book drops stale postings and delete_book restores the stats"""
+    run = ''.join(c for c in uuid.uuid4().hex if c.isalpha())
+    book_id = f'diff_{run}'
+    header = tmp_path / f'header_{book_id}.txt'
+    body = tmp_path / f'body_{book_id}.txt'
+    header.write_text(f'Title: Diff {run}\n', encoding='utf-8')
+    body.write_text(f'diff{run}keep diff{run}keep diff{run}typo diff{run}other', encoding='utf-8')
+
+    metrics = Metrics()
+    backend = instrument_backend(make_backend(backend_class, tmp_path), metrics)
+    indexer = Indexer(backend, manifest_path=tmp_path / 'manifest.json', metrics=metrics)
+    indexer.datalake_path = tmp_path
+    before = backend.get_stats()
+    indexer.reindex_book(book_id)
+    assert backend.get_book_words(book_id) == {f'diff{run}keep': 2, f'diff{run}typo': 1, f'diff{run}other': 1}
+
+    body.write_text(f'diff{run}keep diff{run}keep diff{run}fixed diff{run}other', encoding='utf-8')
+    metrics.reset()
+    indexer.reindex_book(book_id)
+
+    name = backend_class.__name__
+    assert metrics.counter('backend_calls_total', backend=name, method='add_book_postings') == 1
+    assert metrics.counter('backend_calls_total', backend=name, method='remove_book_postings') == 1
+    assert backend.get_book_words(book_id) == {f'diff{run}keep': 2, f'diff{run}fixed': 1, f'diff{run}other': 1}
+    assert indexer.search_books(f'diff{run}typo') == []
+    assert indexer.search_books(f'diff{run}fixed diff{run}keep') == [book_id]
+    assert backend.get_stats()['unique_words'] - before['unique_words'] == 3
+    assert backend.get_stats()['total_books'] - before['total_books'] == 1
+
+    indexer.delete_book(book_id)
+    assert not backend.is_book_indexed(book_id)
+    assert backend.get_book_words(book_id) == {}
+    assert indexer.search_books(f'diff{run}keep') == []
+    assert {key: backend.get_stats()[key] for key in ('total_books', 'unique_words', 'total_word_count')} == {
+        key: before[key] for key in ('total_books', 'unique_words', 'total_word_count')}
+    assert book_id not in indexer.open_manifest()
+
+
+@pytest.mark.parametrize("backend_class", ALL_BACKENDS)
+def test_fielded_search_filters_before_postings(backend_class, tmp_path):
+    """Test title:, author: and lang: filters, their pre-filter path and batched metadata"""
+    run = ''.join(c for c in uuid.uuid4().hex if c.isalpha())
+    books = {
+        f'field_{run}_1': (f'Frankenstein {run}', f'Mary {run} Shelley', 'English', {'monster', f'field{run}'}),
+        f'field_{run}_2': (f'The Last Man {run}', f'Mary {run} Shelley', 'French', {'monster', f'field{run}'}),
+        f'field_{run}_3': (f'Dracula {run}', f'Bram {run} Stoker', 'en', {'monster', 'castle', f'field{run}'}),
+    }
+    metrics = Metrics()
+    backend = instrument_backend(make_backend(backend_class, tmp_path), metrics)
+    indexer = Indexer(backend, metrics=metrics)
+    for book_id, (title, author, language, words) in books.items():
+        indexer.index_book({'book_id': book_id, 'title': title, 'author': author, 'language': language,
+                            'all_words': words, 'word_count': 10})
+    indexer.backend.flush()
+
+    assert sorted(indexer.search_books(f'author:{run} lang:english')) == [f'field_{run}_1', f'field_{run}_3']
+    assert sorted(indexer.search_books(f'author:"shelley {run}"')) == [f'field_{run}_1', f'field_{run}_2']
+    assert indexer.search_books(f'title:{run} author:stoker castle') == [f'field_{run}_3']
+    assert indexer.search_books(f'author:{run} lang:fr field{run}') == [f'field_{run}_2']
+    assert indexer.search_books(f'author:{run} lang:fr castle') == []
+    assert indexer.search_books(f'title:frankenstein author:nobody{run} monster') == []
+
+    # "monster" has more postings than the filter leaves books, so its postings are never fetched
+    name = backend_class.__name__
+    metrics.reset()
+    assert indexer.search_books(f'author:bram author:{run} monster') == [f'field_{run}_3']
+    assert metrics.counter('backend_calls_total', backend=name, method='search_words') == 0
+
+    indexer.index_book({'book_id': f'field_{run}_3', 'title': f'Dracula {run}', 'author': f'Anonymous {run}',
+                        'language': 'en', 'all_words': {'monster'}, 'word_count': 10})
+    assert indexer.search_books(f'author:bram author:{run}') == []
+    indexer.delete_book(f'field_{run}_1')
+    assert indexer.search_books(f'author:{run} lang:english') == [f'field_{run}_3']
+
+    info = indexer.get_books_info([f'field_{run}_2', f'field_{run}_3', f'field_{run}_1'])
+    assert sorted(info) == [f'field_{run}_2', f'field_{run}_3']
+    assert info[f'field_{run}_2']['title'] == f'The Last Man {run}'
+
+
+@pytest.mark.parametrize("backend_class", ALL_BACKENDS)
+def test_boolean_queries_plan_cheapest_first(backend_class, tmp_path):
+    """Test AND / OR / NOT with parentheses, cheapest-first plans, probes and early exit"""
+    run = ''.join(c for c in uuid.uuid4().hex if c.isalpha())
+    books = {
+        f'bool_{run}_1': {f'whale{run}', f'sea{run}', f'ship{run}'},
+        f'bool_{run}_2': {f'whale{run}', f'ship{run}'},
+        f'bool_{run}_3': {f'sea{run}', f'island{run}'},
+        f'bool_{run}_4': {f'ship{run}', f'island{run}', f'rare{run}'},
+    }
+    metrics = Metrics()
+    backend = instrument_backend(make_backend(backend_class, tmp_path), metrics)
+    indexer = Indexer(backend, metrics=metrics)
+    for book_id, words in books.items():
+        indexer.index_book({'book_id': book_id, 'title': f'Boolean {run}', 'all_words': words, 'word_count': 10})
+    indexer.backend.flush()
+
+    def search(query):
+        # NOT alone matches every indexed book, the databases also hold books of other runs
+        return sorted(int(book_id[-1]) for book_id in indexer.search_books(query.replace('~', run)) if book_id in books)
+
+    assert search('whale~ AND sea~') == search('whale~ sea~') == [1]
+    assert search('whale~ OR island~') == [1, 2, 3, 4]
+    assert search('ship~ NOT sea~') == [2, 4]
+    assert search('(whale~ OR island~) AND NOT ship~') == [3]
+    assert search('ship~ AND (sea~ OR rare~)') == [1, 4]
+    assert search('isl* AND NOT (sea~ OR whale~)') == [4]
+    assert search('NOT ship~') == [3]
+
+    # the rarest word runs first, and the OR only probes the one book it left
+    name = backend_class.__name__
+    query = f'(whale{run} OR ship{run}) AND rare{run}'
+    assert indexer.explain(query).splitlines()[1].strip().startswith(f'TERMS rare{run}')
+    metrics.reset()
+    assert search('(whale~ OR ship~) AND rare~') == [4]
+    assert metrics.counter('backend_calls_total', backend=name, method='search_words') == 0
+    plan = indexer.explain(query, analyze=True)
+    assert 'probe, rows=1' in plan and 'skipped' in plan
+
+    # an operand without postings ends the query before anything is fetched
+    metrics.reset()
+    assert search('nothing~ AND NOT sea~ AND (whale~ OR ship~)') == []
+    assert metrics.counter('backend_calls_total', backend=name, method='search_words') == 0
+    assert metrics.counter('backend_calls_total', backend=name, method='search_word') == 0
+
+    # queries that do not parse fall back to their words, ANDed
+    assert search('whale~ AND') == search('OR whale~') == [1, 2]
+    assert search('(whale~ OR sea~') == search('"whale~ OR sea~') == [1]
+    with pytest.raises(ValueError):
+        indexer.explain('whale AND')
+
+
+def test_analyzer_chain_and_stem_memo():
+    """Test Unicode tokens, stopwords, Porter stems and the memo of analyzed tokens"""
+    stemmer = PorterStemmer()
+    assert {stemmer.stem(w) for w in ('walk', 'walks', 'walked', 'walking')} == {'walk'}
+    assert [stemmer.stem(w) for w in ('ponies', 'relational', 'hopping', 'generalization')] == [
+        'poni', 'relat', 'hop', 'gener']
+
+    text = 'The Café and the walkers were walking to Brontë'
+    assert get_analyzer('legacy').analyze(text) == ['the', 'and', 'the', 'walkers', 'were', 'walking']
+    assert get_analyzer('unicode').analyze(text)[1] == 'café'
+    english = get_analyzer('english')
+    assert english.analyze(text) == ['café', 'walker', 'walk', 'brontë']
+    english.analyze('walking walking walking')
+    assert english.memo_info().hits >= 2
+    with pytest.raises(ValueError):
+        get_analyzer('klingon')
+
+
+def test_english_analyzer_shrinks_vocabulary_and_matches_inflections(tmp_path):
+    """Test one analyzer indexes and queries, so inflected query words find their stems"""
+    run = ''.join(c for c in uuid.uuid4().hex if c.isalpha())
+    body = 'He walked and walks, she was walking with the walkers of Montréal. ' * 3
+    (tmp_path / f'header_ana_{run}.txt').write_text('Title: Analyzed\n', encoding='utf-8')
+    (tmp_path / f'body_ana_{run}.txt').write_text(body, encoding='utf-8')
+
+    legacy = Indexer(None)
+    legacy.datalake_path = tmp_path
+    indexer = Indexer(EmbeddedBackend(tmp_path / 'index'), positional=True, analyzer=get_analyzer('english'))
+    indexer.datalake_path = tmp_path
+    book_data = indexer.process_book(f'ana_{run}')
+    assert len(book_data['term_freqs']) < len(legacy.process_book(f'ana_{run}')['term_freqs'])
+    assert book_data['term_freqs'] == {'walk': 9, 'walker': 3, 'montréal': 3}
+    indexer.index_book(book_data)
+
+    assert indexer.search_books('walking') == [f'ana_{run}']
+    assert indexer.search_books('the walk montréal') == [f'ana_{run}']
+    assert indexer.search_books('the was') == []
+    assert indexer.search_books('"walks she was walking"') == [f'ana_{run}']
+    assert indexer.search_books('"walks was she walking"') == [f'ana_{run}']
+    assert indexer.search_books('"walking walks"') == []
 
 
 def test_missing_book_metadata():